@@ -2,7 +2,7 @@
 import unittest
 import time
 from threading import Thread
-from tindo import Local
+from tindo import Local, release_local, set_ident_func
 
 
 class TestLocal(unittest.TestCase):
@@ -28,6 +28,38 @@ class TestLocal(unittest.TestCase):
         t.join()
         self.assertEqual(ctx.name, 'main')
 
+    def testRelease(self):
+        local = Local()
+        local.name = 'main'
+        self.assertEqual(len(local.__storage__), 1)
+        release_local(local)
+        self.assertEqual(local.__storage__, {})
+        with self.assertRaises(AttributeError):
+            local.name
+        release_local(local)
+
+    def testCurrent(self):
+        local = Local()
+        c = local()
+        c.name = 'main'
+        self.assertEqual(local.name, 'main')
+        local.age = 12
+        self.assertEqual(c.age, 12)
+        self.assertTrue(local() is c)
+
+    def testIdentFunc(self):
+        idents = ['a']
+        local = Local(ident_func=lambda: idents[0])
+        local.name = 'a'
+        idents[0] = 'b'
+        with self.assertRaises(AttributeError):
+            local.name
+        local.name = 'b'
+        idents[0] = 'a'
+        self.assertEqual(local.name, 'a')
+        set_ident_func(local, lambda: 'b')
+        self.assertEqual(local.name, 'b')
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
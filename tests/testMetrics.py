@@ -0,0 +1,97 @@
+# -*- coding:utf-8 -*-
+import os
+import unittest
+from StringIO import StringIO
+from tindo import Tindo, Metrics, route
+from testTindo import _call
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.app = Tindo(os.path.dirname(os.path.abspath(__file__)), metrics=Metrics(buckets=(0.1, 1.0)))
+
+        @route('/user/<name>')
+        def user(name):
+            return 'user %s' % name
+
+        @route('/stream')
+        def stream():
+            return (c for c in 'abc')
+
+        self.app.add_url(user)
+        self.app.add_url(stream)
+
+    def testInfo(self):
+        _call(self.app, '/user/a')
+        _call(self.app, '/user/b')
+        self.assertEqual(_call(self.app, '/missing')['status'][:3], '404')
+        info = self.app.metrics.info
+        self.assertEqual(info.in_flight, 0)
+        self.assertEqual(info.statuses, {200: 2, 404: 1})
+        user = info.routes['GET /user/<name>']
+        self.assertEqual(user.count, 2)
+        self.assertEqual(user.buckets[-1], (float('inf'), 2))
+        self.assertEqual(info.routes['GET unmatched'].count, 1)
+        self.assertEqual(info.phases['handler'].count, 2)
+        self.assertEqual(info.phases['body'].count, 3)
+
+    def testStream(self):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/stream', 'wsgi.input': StringIO('')}
+        body = self.app(environ, lambda status, headers: None)
+        self.assertEqual(self.app.metrics.in_flight, 1)
+        self.assertEqual(''.join(body), 'abc')
+        body.close()
+        self.assertEqual(self.app.metrics.in_flight, 0)
+        self.assertEqual(self.app.metrics.info.routes['GET /stream'].count, 1)
+
+    def testFileWrapper(self):
+        import shutil
+        import tempfile
+        from wsgiref.util import FileWrapper
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root, 'static'))
+            with open(os.path.join(root, 'static', 'style.css'), 'wb') as f:
+                f.write('body {}')
+            app = Tindo(root, metrics=True)
+            environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/static/style.css', 'wsgi.input': StringIO(''),
+                       'wsgi.file_wrapper': FileWrapper}
+            body = app(environ, lambda status, headers: None)
+            self.assertTrue(isinstance(body, FileWrapper))
+            self.assertEqual(''.join(body), 'body {}')
+            body.close()
+            self.assertEqual(app.metrics.in_flight, 0)
+            self.assertEqual(app.metrics.info.routes['GET /static/<path>'].count, 1)
+        finally:
+            shutil.rmtree(root)
+
+    def testError(self):
+        def fail(*args):
+            raise RuntimeError('fail')
+        self.app._wsgi_app = fail
+        with self.assertRaises(RuntimeError):
+            _call(self.app, '/user/a')
+        self.assertEqual(self.app.metrics.in_flight, 0)
+        self.assertEqual(self.app.metrics.info.statuses, {500: 1})
+
+    def testPrometheus(self):
+        _call(self.app, '/user/a')
+        r = _call(self.app, '/metrics')
+        self.assertEqual(r['status'][:3], '200')
+        text = r['body']
+        self.assertIn('# TYPE tindo_request_duration_seconds histogram', text)
+        self.assertIn('tindo_request_duration_seconds_bucket{method="GET",route="/user/<name>",le="0.1"} 1', text)
+        self.assertIn('tindo_request_duration_seconds_bucket{method="GET",route="/user/<name>",le="+Inf"} 1', text)
+        self.assertIn('tindo_request_duration_seconds_count{method="GET",route="/user/<name>"} 1', text)
+        self.assertIn('tindo_responses_total{status="200"} 1', text)
+        self.assertIn('tindo_requests_in_flight 1', text)
+        self.assertIn('tindo_sessions 0', text)
+
+    def testDisabled(self):
+        app = Tindo(os.path.dirname(os.path.abspath(__file__)))
+        self.assertIsNone(app.metrics)
+        self.assertEqual(_call(app, '/metrics')['status'][:3], '404')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# -*- coding:utf-8 -*-
+import unittest
+from StringIO import StringIO
+from tindo import HttpError, Request
+from tindo.multipart import parse_multipart, MultipartPart, MultipartError
+
+BOUNDARY = '----tindoBoundary'
+
+
+def _body(*parts):
+    lines = []
+    for name, value, filename in parts:
+        lines.append('--' + BOUNDARY)
+        if filename is None:
+            lines.append('Content-Disposition: form-data; name="%s"' % name)
+        else:
+            lines.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (name, filename))
+            lines.append('Content-Type: text/plain')
+        lines.append('')
+        lines.append(value)
+    lines.append('--' + BOUNDARY + '--')
+    lines.append('')
+    return '\r\n'.join(lines)
+
+
+def _chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestParseMultipart(unittest.TestCase):
+    def testFields(self):
+        body = _body(('a', '1', None), ('c', '\xe4\xb8\xad', None), ('c', '', None),
+                     ('f', 'line\r\n--not boundary\r\n', 'a.txt'))
+        for size in (1, 7, 64, len(body)):
+            fields = parse_multipart(_chunks(body, size), BOUNDARY)
+            self.assertEqual(fields[:3], [('a', u'1'), ('c', u'中'), ('c', u'')])
+            name, part = fields[3]
+            self.assertEqual(name, 'f')
+            self.assertTrue(isinstance(part, MultipartPart))
+            self.assertEqual(part.filename, 'a.txt')
+            self.assertEqual(part.content_type, 'text/plain')
+            self.assertEqual(part.file.read(), 'line\r\n--not boundary\r\n')
+
+    def testSpool(self):
+        body = _body(('f', 'x' * 1000, 'big.bin'), ('g', 'x' * 10, 'small.bin'))
+        fields = parse_multipart(_chunks(body, 100), BOUNDARY, spool_threshold=100)
+        self.assertTrue(fields[0][1].file._rolled)
+        self.assertFalse(fields[1][1].file._rolled)
+        self.assertEqual(fields[0][1].file.read(), 'x' * 1000)
+
+    def testLimits(self):
+        body = _body(('a', 'x' * 100, None), ('b', '1', None))
+        with self.assertRaises(HttpError):
+            parse_multipart([body], BOUNDARY, max_part_size=99)
+        with self.assertRaises(HttpError):
+            parse_multipart([body], BOUNDARY, max_fields=1)
+        self.assertEqual(len(parse_multipart([body], BOUNDARY, max_part_size=100, max_fields=2)), 2)
+        with self.assertRaises(HttpError):
+            parse_multipart([body], BOUNDARY, max_field_size=99)
+        files = _body(('f', 'x' * 100, 'a.txt'))
+        self.assertEqual(len(parse_multipart([files], BOUNDARY, max_field_size=99)), 1)
+
+    def testMalformed(self):
+        body = _body(('a', '1', None))
+        with self.assertRaises(MultipartError):
+            parse_multipart([body[:-10]], BOUNDARY)
+        with self.assertRaises(MultipartError):
+            parse_multipart([body.replace('form-data; ', '')], BOUNDARY)
+
+
+class TestRequestMultipart(unittest.TestCase):
+    def _request(self, body, **kw):
+        return Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO(body),
+                        'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % BOUNDARY,
+                        'CONTENT_LENGTH': str(len(body))}, **kw)
+
+    def testInput(self):
+        r = self._request(_body(('a', '1', None), ('c', 'A', None), ('c', 'B', None),
+                                ('f', 'content', 'a.txt'), ('empty', '', '')))
+        self.assertEqual(r['a'], u'1')
+        self.assertEqual(r.gets('c'), [u'A', u'B'])
+        self.assertEqual(r['f'].filename, u'a.txt')
+        self.assertEqual(r['f'].file.read(), 'content')
+        self.assertEqual(r['empty'], u'')
+
+    def testTooLarge(self):
+        body = _body(('a', 'x' * 100, None))
+        with self.assertRaises(HttpError):
+            self._request(body, max_body_size=10).get('a')
+        with self.assertRaises(HttpError):
+            self._request(body, max_part_size=10).get('a')
+        with self.assertRaises(HttpError):
+            self._request(body, max_field_size=10).get('a')
+
+
+if __name__ == '__main__':
+    unittest.main()
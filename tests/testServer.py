@@ -0,0 +1,214 @@
+# -*- coding:utf-8 -*-
+import os
+import time
+import shutil
+import socket
+import httplib
+import tempfile
+import threading
+import unittest
+from tindo import Tindo, PreforkServer, ThreadPoolServer, route, ctx
+
+
+class TestPreforkServer(unittest.TestCase):
+    def setUp(self):
+        self.app = Tindo(os.path.dirname(os.path.abspath(__file__)))
+
+        @route('/echo', methods=['POST'])
+        def echo():
+            return ctx.request.get_body()
+
+        @route('/stream')
+        def stream():
+            ctx.response.content_type = 'text/plain'
+            return (str(i) for i in range(3))
+
+        self.app.add_url(echo)
+        self.app.add_url(stream)
+
+    def _start(self, **kw):
+        server = PreforkServer(self.app, port=0, workers=1, **kw)
+        sock = server.bind()
+        t = threading.Thread(target=server.serve_worker, args=(sock,))
+        t.daemon = True
+        t.start()
+        return server, t
+
+    def testKeepAlive(self):
+        server, t = self._start()
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+        conn.request('POST', '/echo', 'hello', {'Content-Type': 'text/plain'})
+        r = conn.getresponse()
+        self.assertEqual(r.status, 200)
+        self.assertEqual(r.read(), 'hello')
+        self.assertEqual(r.getheader('content-length'), '5')
+        conn.request('GET', '/stream')
+        r = conn.getresponse()
+        self.assertEqual(r.getheader('transfer-encoding'), 'chunked')
+        self.assertEqual(r.read(), '012')
+        conn.request('GET', '/missing')
+        self.assertEqual(conn.getresponse().status, 404)
+        conn.close()
+        self.assertEqual(server.requests, 3)
+        server.alive = False
+        t.join(5)
+        self.assertFalse(t.is_alive())
+
+    def testMaxRequests(self):
+        server, t = self._start(max_requests=2)
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+        conn.request('GET', '/stream')
+        self.assertEqual(conn.getresponse().read(), '012')
+        conn.request('GET', '/stream')
+        r = conn.getresponse()
+        self.assertEqual(r.getheader('connection'), 'close')
+        self.assertEqual(r.read(), '012')
+        t.join(5)
+        self.assertFalse(t.is_alive())
+
+    def testMaxRss(self):
+        from tindo import server as server_module
+        rss = server_module._rss
+        self.assertTrue(rss() > 0)
+        server_module._rss = lambda: None
+        try:
+            self.assertIsNone(PreforkServer(self.app, port=0, workers=1, max_rss=1).max_rss)
+        finally:
+            server_module._rss = rss
+        server, t = self._start(max_rss=1)
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+        conn.request('GET', '/stream')
+        self.assertEqual(conn.getresponse().read(), '012')
+        t.join(5)
+        self.assertFalse(t.is_alive())
+
+    def testSlowUpload(self):
+        server, t = self._start(keepalive_timeout=0.1, timeout=5)
+        sock = socket.create_connection(('127.0.0.1', server.server_port), 5)
+        sock.sendall('POST /echo HTTP/1.1\r\nHost: localhost\r\nContent-Type: text/plain\r\n'
+                     'Content-Length: 5\r\n\r\nhe')
+        time.sleep(0.3)
+        sock.sendall('llo')
+        response = sock.recv(4096)
+        sock.close()
+        self.assertTrue(response.startswith('HTTP/1.1 200'))
+        self.assertTrue(response.endswith('\r\n\r\nhello'))
+        server.alive = False
+        t.join(5)
+
+    def testFileWrapper(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root, 'static'))
+            with open(os.path.join(root, 'static', 'data.bin'), 'wb') as f:
+                f.write('x' * 100000)
+            self.app = Tindo(root)
+            server, t = self._start()
+            conn = httplib.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+            conn.request('GET', '/static/data.bin')
+            r = conn.getresponse()
+            self.assertEqual(r.getheader('content-length'), '100000')
+            self.assertEqual(r.read(), 'x' * 100000)
+            conn.request('HEAD', '/static/data.bin')
+            r = conn.getresponse()
+            self.assertEqual(r.status, 200)
+            self.assertEqual(r.getheader('content-length'), '100000')
+            self.assertEqual(r.read(), '')
+            conn.request('GET', '/static/data.bin')
+            self.assertEqual(conn.getresponse().read(), 'x' * 100000)
+            conn.close()
+            server.alive = False
+            t.join(5)
+        finally:
+            shutil.rmtree(root)
+
+
+class TestThreadPoolServer(unittest.TestCase):
+    def testBackpressure(self):
+        app = Tindo(os.path.dirname(os.path.abspath(__file__)))
+        entered = threading.Event()
+        release = threading.Event()
+
+        @route('/block')
+        def block():
+            entered.set()
+            release.wait(5)
+            return 'done'
+
+        app.add_url(block)
+        server = ThreadPoolServer(app, port=0, threads=1, queue_size=1)
+        t = threading.Thread(target=server.serve_forever, args=(server.bind(),))
+        t.daemon = True
+        t.start()
+        first = httplib.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+        first.request('GET', '/block')
+        self.assertTrue(entered.wait(5))
+        second = httplib.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+        second.request('GET', '/block')
+        for _ in range(100):
+            if server.info.queued == 1:
+                break
+            time.sleep(0.01)
+        third = httplib.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+        third.request('GET', '/block')
+        r = third.getresponse()
+        self.assertEqual(r.status, 503)
+        self.assertEqual(r.getheader('retry-after'), '1')
+        self.assertEqual(r.read(), '')
+        release.set()
+        self.assertEqual(first.getresponse().read(), 'done')
+        self.assertEqual(second.getresponse().read(), 'done')
+        for _ in range(100):
+            if server.info.requests == 2:
+                break
+            time.sleep(0.01)
+        info = server.info
+        self.assertEqual(info.rejected, 1)
+        self.assertEqual(info.connections, 2)
+        self.assertEqual(info.requests, 2)
+        self.assertTrue(info.max_queue_time > 0)
+        self.assertTrue(info.handler_time >= info.max_handler_time > 0)
+        server.stop()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+
+    def testRejectIdle(self):
+        app = Tindo(os.path.dirname(os.path.abspath(__file__)))
+        release = threading.Event()
+
+        @route('/block')
+        def block():
+            release.wait(5)
+            return 'done'
+
+        app.add_url(block)
+        server = ThreadPoolServer(app, port=0, threads=1, queue_size=1)
+        server.reject_linger_time = 0.5
+        t = threading.Thread(target=server.serve_forever, args=(server.bind(),))
+        t.daemon = True
+        t.start()
+        idle = [socket.create_connection(('127.0.0.1', server.server_port), 5)]
+        for _ in range(100):
+            if server.info.connections == 1:
+                break
+            time.sleep(0.01)
+        idle += [socket.create_connection(('127.0.0.1', server.server_port), 5) for _ in range(11)]
+        for _ in range(100):
+            if server.info.rejected == 10:
+                break
+            time.sleep(0.01)
+        start = time.time()
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+        conn.request('GET', '/block')
+        self.assertEqual(conn.getresponse().status, 503)
+        self.assertTrue(time.time() - start < 0.5)
+        for sock in idle:
+            sock.close()
+        release.set()
+        server.stop()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
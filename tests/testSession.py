@@ -0,0 +1,195 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from tindo import Session, MemorySessionStore, SignedCookieSessionStore, SQLiteSessionStore
+from tindo import Tindo, route, ctx
+from testTindo import _call
+
+
+class TestSession(unittest.TestCase):
+    def testModified(self):
+        session = Session(('a',), (1,))
+        self.assertFalse(session.modified)
+        self.assertEqual(session.a, 1)
+        session.b = 2
+        self.assertTrue(session.modified)
+        self.assertFalse('modified' in session)
+        session.modified = False
+        session.pop('a')
+        self.assertTrue(session.modified)
+
+
+class TestMemorySessionStore(unittest.TestCase):
+    def testLoad(self):
+        store = MemorySessionStore()
+        session = store.load('a')
+        session.name = 'tindo'
+        self.assertEqual(store.load('a').name, 'tindo')
+        self.assertEqual(len(store), 1)
+        store.delete('a')
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.load('a'), {})
+
+    def testExpire(self):
+        store = MemorySessionStore(shards=4, ttl=-1)
+        store.load('a').name = 'tindo'
+        self.assertEqual(store.load('a'), {})
+        self.assertEqual(store.sweep(), 1)
+        self.assertEqual(len(store), 0)
+
+    def testMaxSessions(self):
+        store = MemorySessionStore(shards=1, max_sessions=2)
+        store.load('a')
+        store.load('b')
+        store.load('a')
+        store.load('c')
+        self.assertEqual(len(store), 2)
+        store.load('a').name = 'kept'
+        self.assertEqual(store.load('a').name, 'kept')
+        store = MemorySessionStore(max_sessions=10)
+        for i in range(100):
+            store.load(str(i))
+        self.assertEqual(len(store), 10)
+
+    def testGet(self):
+        store = MemorySessionStore(shards=1, max_sessions=2)
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(len(store), 0)
+        store.load('a').name = 'tindo'
+        self.assertEqual(store.get('a').name, 'tindo')
+
+
+class TestSignedCookieSessionStore(unittest.TestCase):
+    def testDumpsLoads(self):
+        store = SignedCookieSessionStore('secret')
+        value = store.dumps(Session(('name', 'items'), (u'tindo', range(100))))
+        session = store.loads(value)
+        self.assertEqual(session, {'name': u'tindo', 'items': range(100)})
+        self.assertFalse(session.modified)
+        self.assertTrue(value.startswith('.'))
+        self.assertIsNone(SignedCookieSessionStore('other').loads(value))
+        self.assertIsNone(store.loads(value[:-2]))
+        self.assertIsNone(store.loads('garbage'))
+        self.assertIsNone(SignedCookieSessionStore('secret', max_age=-1).loads(value))
+
+
+class TestSQLiteSessionStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'sessions.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def testFlush(self):
+        store = SQLiteSessionStore(self.path)
+        session = store.load('a')
+        session.name = 'tindo'
+        self.assertTrue(store.load('a') is session)
+        store.load('b')
+        self.assertEqual(len(store), 0)
+        store.flush()
+        self.assertEqual(len(store), 1)
+        other = SQLiteSessionStore(self.path)
+        self.assertEqual(other.load('a'), {'name': 'tindo'})
+        other.delete('a')
+        other.flush()
+        self.assertEqual(len(store), 0)
+
+    def testExpire(self):
+        store = SQLiteSessionStore(self.path, ttl=-1)
+        store.load('a').name = 'tindo'
+        store.flush()
+        self.assertEqual(store.load('a'), {})
+        self.assertEqual(len(store), 0)
+
+    def testJSON(self):
+        store = SQLiteSessionStore(self.path)
+        store.load('a').update(name='tindo', roles=['admin'])
+        store.load('a').modified = True
+        store.flush()
+        other = SQLiteSessionStore(self.path)
+        self.assertEqual(other.load('a'), {'name': 'tindo', 'roles': ['admin']})
+        store._connect().execute("UPDATE sessions SET data = 'invalid' WHERE id = 'a'")
+        self.assertEqual(SQLiteSessionStore(self.path).load('a'), {})
+        store.load('b').value = object()
+        self.assertRaises(TypeError, store.flush)
+
+    def testGet(self):
+        store = SQLiteSessionStore(self.path)
+        self.assertIsNone(store.get('a'))
+        store.flush()
+        self.assertEqual(len(store), 0)
+        store.load('a').name = 'tindo'
+        self.assertTrue(store.get('a') is store.load('a'))
+        store.flush()
+        self.assertEqual(SQLiteSessionStore(self.path).get('a'), {'name': 'tindo'})
+
+
+class TestSessionStore(unittest.TestCase):
+    def testSignedCookie(self):
+        app = Tindo(os.path.dirname(os.path.abspath(__file__)), session_store=SignedCookieSessionStore('secret'))
+
+        @route('/count')
+        def count():
+            session = ctx.response.session
+            session.count = session.get('count', 0) + 1
+            return str(session.count)
+
+        @route('/show')
+        def show():
+            session = ctx.request.session
+            return str(session.count)
+        app.add_url(count)
+        app.add_url(show)
+        r = _call(app, '/count')
+        self.assertEqual(r['body'], '1')
+        r = _call(app, '/count', HTTP_COOKIE=r['headers']['Set-Cookie'].split(';')[0])
+        self.assertEqual(r['body'], '2')
+        r = _call(app, '/show', HTTP_COOKIE=r['headers']['Set-Cookie'].split(';')[0])
+        self.assertEqual(r['body'], '2')
+        self.assertFalse('Set-Cookie' in r['headers'])
+
+    def testApplication(self):
+        store = MemorySessionStore()
+        app = Tindo(os.path.dirname(os.path.abspath(__file__)), session_store=store)
+
+        @route('/count')
+        def count():
+            session = ctx.response.session
+            session.count = ctx.response.session.get('count', 0) + 1
+            return str(session.count)
+        app.add_url(count)
+        r = _call(app, '/count')
+        self.assertEqual(r['body'], '1')
+        self.assertEqual(len(store), 1)
+        r = _call(app, '/count', HTTP_COOKIE=r['headers']['Set-Cookie'].split(';')[0])
+        self.assertEqual(r['body'], '2')
+        self.assertEqual(len(store), 1)
+
+    def testForgedSessionId(self):
+        store = MemorySessionStore(max_sessions=3)
+        app = Tindo(os.path.dirname(os.path.abspath(__file__)), session_store=store)
+
+        @route('/login')
+        def login():
+            ctx.response.session.user = 'tindo'
+            return 'ok'
+
+        @route('/user')
+        def user():
+            session = ctx.request.session
+            return 'anonymous' if session is None else session.user
+        app.add_url(login)
+        app.add_url(user)
+        cookie = _call(app, '/login')['headers']['Set-Cookie'].split(';')[0]
+        for i in range(10):
+            self.assertEqual(_call(app, '/user', HTTP_COOKIE='sessionid=forged%d' % i)['body'], 'anonymous')
+        self.assertEqual(len(store), 1)
+        self.assertEqual(_call(app, '/user', HTTP_COOKIE=cookie)['body'], 'tindo')
+
+
+if __name__ == '__main__':
+    unittest.main()
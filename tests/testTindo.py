@@ -1,12 +1,16 @@
 import unittest
 import datetime
+import os
 import sys
-from tindo import Dict, UTC
+import zlib
+import threading
+from tindo import Dict, UTC, LRUCache, SQLiteSessionStore, MemorySessionStore
 from tindo import HttpError, RedirectError, bad_request, unauthorized, forbidden, RE_RESPONSE_STATUS
 from tindo import internal_error, redirect, found, see_other
 from tindo import to_str, to_unicode, quote, unquote, RESPONSE_STATUSES
-from tindo import get, post, Request, Response, route
-from tindo.tindo import _build_regex, _load_module
+from tindo.http import parse_range_header, accepts_encoding
+from tindo import get, post, Request, Response, route, view, ctx, Tindo, JSONResponse, HttpError
+from tindo.tindo import _build_regex, _load_module, Route, Router
 from StringIO import StringIO
 
 
@@ -22,6 +26,33 @@ class TestDict(unittest.TestCase):
             print(d1.empty)
 
 
+class TestLRUCache(unittest.TestCase):
+    def testEviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.info, {'hits': 2, 'misses': 1, 'size': 2, 'currsize': 2, 'maxsize': 2})
+        cache.clear()
+        self.assertFalse('a' in cache)
+
+    def testSizeof(self):
+        cache = LRUCache(10, sizeof=len)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 4)
+        cache.set('c', 'x' * 11)
+        self.assertFalse('c' in cache)
+        cache.set('c', 'x' * 4)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.currsize, 8)
+        self.assertEqual(cache.pop('b'), 'xxxx')
+        self.assertEqual(cache.currsize, 4)
+
+
 class TestUTC(unittest.TestCase):
     def testUtc(self):
         tz0 = UTC('+00:00')
@@ -97,6 +128,28 @@ def testpost():
     return '200'
 
 
+class TestRangeHeader(unittest.TestCase):
+    def testParse(self):
+        self.assertEqual(parse_range_header('bytes=0-499', 1000), [(0, 500)])
+        self.assertEqual(parse_range_header('bytes=500-', 1000), [(500, 1000)])
+        self.assertEqual(parse_range_header('bytes=-300', 1000), [(700, 1000)])
+        self.assertEqual(parse_range_header('bytes=0-0, 900-2000', 1000), [(0, 1), (900, 1000)])
+        self.assertEqual(parse_range_header('bytes=1000-', 1000), [])
+        self.assertIsNone(parse_range_header('bytes=5-1', 1000))
+        self.assertIsNone(parse_range_header('bytes=a-b', 1000))
+        self.assertIsNone(parse_range_header('items=0-1', 1000))
+
+
+class TestAcceptEncoding(unittest.TestCase):
+    def testAccepts(self):
+        self.assertTrue(accepts_encoding('gzip, deflate', 'gzip'))
+        self.assertTrue(accepts_encoding('deflate;q=0.5, GZIP;q=0.8', 'gzip'))
+        self.assertTrue(accepts_encoding('*', 'gzip'))
+        self.assertFalse(accepts_encoding('*, gzip;q=0', 'gzip'))
+        self.assertFalse(accepts_encoding('deflate', 'gzip'))
+        self.assertFalse(accepts_encoding(None, 'gzip'))
+
+
 class TestMethods(unittest.TestCase):
     def testMethod(self):
         self.assertEqual(testget.__web_route__, '/test/:id')
@@ -112,22 +165,59 @@ class TestBuildRegex(unittest.TestCase):
                                       '^\\/path\\/to\\/(?P<name>[^\\/]+)\\/(?P<comment>[^\\/]+)$')
 
 
+class TestRouter(unittest.TestCase):
+    def _route(self, path):
+        @route(path)
+        def handler(*args):
+            return args
+        return Route(handler)
+
+    def testMatch(self):
+        router = Router()
+        routes = [self._route(p) for p in ('/', '/user/<name>', '/user/admin',
+                                           '/user/<name>/<group>', '/file/<name>.html')]
+        for r in routes:
+            router.add(r)
+        self.assertEqual(len(router), 5)
+        self.assertEqual(router.match('/'), (routes[0], ()))
+        self.assertEqual(router.match('/user/bob'), (routes[1], ('bob',)))
+        self.assertEqual(router.match('/user/admin'), (routes[2], ()))
+        self.assertEqual(router.match('/user/bob/dev'), (routes[3], ('bob', 'dev')))
+        self.assertEqual(router.match('/file/readme.html'), (routes[4], ('readme',)))
+        self.assertIsNone(router.match('/user/'))
+        self.assertIsNone(router.match('/file/readme.txt'))
+        self.assertIsNone(router.match('/nothing'))
+
+    def testBacktrack(self):
+        router = Router()
+        param = self._route('/<a>/edit')
+        static = self._route('/user/<name>')
+        router.add(param)
+        router.add(static)
+        self.assertEqual(router.match('/user/edit'), (static, ('edit',)))
+        self.assertEqual(router.match('/user/bob'), (static, ('bob',)))
+        self.assertEqual(router.match('/post/edit'), (param, ('post',)))
+
+
 class TestRequest(unittest.TestCase):
     def testGetItem(self):
-        r = Request({'REQUEST_METHOD':'POST', 'wsgi.input': StringIO('a=1&b=M%20M&c=ABC&c=XYZ&e=')})
+        r = Request({'REQUEST_METHOD':'POST', 'wsgi.input': StringIO('a=1&b=M%20M&c=ABC&c=XYZ&e='),
+                     'CONTENT_LENGTH': '26'})
         self.assertEqual(r['a'], u'1')
         self.assertEqual(r['c'], u'ABC')
         with self.assertRaises(KeyError):
             r['empty']
 
-        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('a=1&b=M%20M&c=ABC&c=XYZ&e=')})
+        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('a=1&b=M%20M&c=ABC&c=XYZ&e='),
+                     'CONTENT_LENGTH': '26'})
         self.assertEqual(r.get('a'), u'1')
         self.assertEqual(r.gets('c'), [u'ABC', u'XYZ'])
         with self.assertRaises(KeyError):
             r.gets('empty')
 
     def testInputItem(self):
-        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('a=1&b=M%20M&c=ABC&c=XYZ&e=')})
+        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('a=1&b=M%20M&c=ABC&c=XYZ&e='),
+                     'CONTENT_LENGTH': '26'})
         i = r.input(x=2017)
         self.assertEqual(i.x, 2017)
         self.assertEqual(i.a, u'1')
@@ -135,10 +225,66 @@ class TestRequest(unittest.TestCase):
         self.assertEqual(i.c, u'ABC')
         self.assertEqual(i.get('d', u'2008'), '2008')
 
+    def testArgsForm(self):
+        r = Request({'REQUEST_METHOD': 'GET', 'QUERY_STRING': 'page=2&q=a+b%21&q=&tag', 'wsgi.input': None})
+        self.assertEqual(r.args, {'page': u'2', 'q': [u'a b!', u''], 'tag': u''})
+        self.assertEqual(r.form, {})
+        self.assertEqual(r.get('page'), u'2')
+        self.assertEqual(r.gets('q'), [u'a b!', u''])
+
+        r = Request({'REQUEST_METHOD': 'POST', 'QUERY_STRING': 'a=query&b=2', 'CONTENT_LENGTH': '18',
+                     'CONTENT_TYPE': 'application/x-www-form-urlencoded', 'wsgi.input': StringIO('a=body&c=%E4%B8%AD')})
+        self.assertEqual(r.args, {'a': u'query', 'b': u'2'})
+        self.assertEqual(r.form, {'a': u'body', 'c': u'\u4e2d'})
+        self.assertEqual(r['a'], u'body')
+        self.assertEqual(r.gets('a'), [u'body', u'query'])
+        self.assertEqual(r.input(), {'a': u'body', 'b': u'2', 'c': u'\u4e2d'})
+
+        r = Request({'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': 'application/json', 'wsgi.input': StringIO('{}'),
+                     'CONTENT_LENGTH': '2'})
+        self.assertEqual(r.form, {})
+        self.assertEqual(r.get_body(), '{}')
+
+    def testJson(self):
+        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('{"a": [1, 2]}'), 'CONTENT_LENGTH': '13'})
+        self.assertEqual(r.json, {'a': [1, 2]})
+        self.assertTrue(r.json is r.json)
+        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('{"a": '), 'CONTENT_LENGTH': '6'})
+        with self.assertRaises(HttpError):
+            r.json
+        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('[1, 2, 3]'), 'CONTENT_LENGTH': '9'},
+                    max_json_size=5)
+        with self.assertRaises(HttpError):
+            r.json
+        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO(''), 'CONTENT_LENGTH': '0'})
+        self.assertIsNone(r.json)
+
     def testBody(self):
-        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('<xml><raw/>')})
+        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('<xml><raw/>'), 'CONTENT_LENGTH': '11'})
         self.assertEqual(r.get_body(), '<xml><raw/>')
 
+    def testBoundedBody(self):
+        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('a=1&b=2trailing'), 'CONTENT_LENGTH': '7'})
+        self.assertEqual(r.get_body(), 'a=1&b=2')
+        self.assertEqual(r.input(), {'a': u'1', 'b': u'2'})
+        self.assertEqual(list(r.stream(3)), ['a=1', '&b=', '2'])
+        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('x' * 100), 'CONTENT_LENGTH': '100'},
+                    max_body_size=10)
+        with self.assertRaises(HttpError):
+            r.get_body()
+        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('x' * 100), 'wsgi.input_terminated': True},
+                    max_body_size=10)
+        with self.assertRaises(HttpError):
+            list(r.stream())
+        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('x' * 100)})
+        self.assertEqual(r.get_body(), '')
+
+    def testStream(self):
+        r = Request({'REQUEST_METHOD': 'POST', 'wsgi.input': StringIO('x' * 10), 'CONTENT_LENGTH': '10'})
+        self.assertEqual(list(r.stream(4)), ['xxxx', 'xxxx', 'xx'])
+        with self.assertRaises(RuntimeError):
+            r.get_body()
+
     def testRemote_Addr(self):
         r = Request({'REMOTE_ADDR': '192.168.0.100'})
         self.assertEqual(r.remote_addr, '192.168.0.100')
@@ -195,6 +341,16 @@ class TestResponse(unittest.TestCase):
         r.set_header('content-type', 'image/png')
         self.assertEqual(r.header('content-type'), 'image/png')
 
+    def testCustomHeader(self):
+        r = Response()
+        r.set_header('X-Request-Id', 'abc')
+        self.assertEqual(r.header('x-request-id'), 'abc')
+        self.assertTrue(('X-Request-Id', 'abc') in r.headers)
+        r.set_header('etag', '"v1"')
+        self.assertTrue(('ETag', '"v1"') in r.headers)
+        r.unset_header('X-REQUEST-ID')
+        self.assertIsNone(r.header('X-Request-Id'))
+
     def testContent(self):
         r = Response()
         self.assertEqual(r.content_type, 'text/html; charset=utf-8')
@@ -259,5 +415,523 @@ class TestRoute(unittest.TestCase):
         self.assertEqual(home.__web_method__, ['GET', 'POST'])
 
 
+def _call(app, path, method='GET', body='', **environ):
+    environ.update({'REQUEST_METHOD': method, 'PATH_INFO': path, 'wsgi.input': StringIO(body)})
+    result = {}
+
+    def start_response(status, headers):
+        result['status'] = status
+        result['headers'] = dict(headers)
+    body = app(environ, start_response)
+    result['body'] = ''.join(body)
+    if hasattr(body, 'close'):
+        body.close()
+    return result
+
+
+class _ThreadPool(object):
+    """
+    run each call in a new thread, like the thread pool of gevent.
+    """
+    def apply(self, func, args):
+        result = []
+        t = threading.Thread(target=lambda: result.append(func(*args)))
+        t.start()
+        t.join()
+        return result[0]
+
+
+class TestDispatch(unittest.TestCase):
+    def setUp(self):
+        self.app = Tindo(os.path.dirname(os.path.abspath(__file__)))
+
+        @route('/item/<name>', methods=['GET', 'PUT', 'delete'])
+        def item(name):
+            return 'item %s' % name
+
+        @route('/item/new', methods=['GET'])
+        def new_item():
+            return 'new item'
+
+        @route('/items', methods=['PATCH'])
+        def items():
+            return 'patched'
+
+        for fn in (item, new_item, items):
+            self.app.add_url(fn)
+
+    def testMethods(self):
+        self.assertEqual(_call(self.app, '/item/a')['body'], 'item a')
+        self.assertEqual(_call(self.app, '/item/new')['body'], 'new item')
+        self.assertEqual(_call(self.app, '/item/b', method='PUT')['body'], 'item b')
+        self.assertEqual(_call(self.app, '/item/c', method='DELETE')['body'], 'item c')
+        self.assertEqual(_call(self.app, '/items', method='PATCH')['body'], 'patched')
+
+    def testBlocking(self):
+        @route('/blocking', blocking=True)
+        def blocking():
+            return '%s %s' % (ctx.request.path_info, threading.current_thread() is main)
+
+        main = threading.current_thread()
+        self.app._running = False
+        self.app.add_url(blocking)
+        self.assertEqual(_call(self.app, '/blocking')['body'], '/blocking True')
+        self.app._threadpool = _ThreadPool()
+        self.assertEqual(_call(self.app, '/blocking')['body'], '/blocking False')
+        self.assertEqual(_call(self.app, '/item/a')['body'], 'item a')
+        self.assertEqual(len(ctx.__storage__), 0)
+
+    def testBlockingSession(self):
+        import shutil
+        import tempfile
+        root = tempfile.mkdtemp()
+        try:
+            store = SQLiteSessionStore(os.path.join(root, 'sessions.db'))
+            app = Tindo(os.path.dirname(os.path.abspath(__file__)), session_store=store)
+
+            @route('/login', blocking=True)
+            def login():
+                ctx.response.session.name = 'tindo'
+                return 'ok'
+            app.add_url(login)
+            app._threadpool = _ThreadPool()
+            _call(app, '/login')
+            self.assertEqual(len(store), 1)
+        finally:
+            shutil.rmtree(root)
+
+    def testSessionFlushError(self):
+        import shutil
+        import tempfile
+        root = tempfile.mkdtemp()
+        try:
+            store = SQLiteSessionStore(os.path.join(root, 'sessions.db'))
+            app = Tindo(os.path.dirname(os.path.abspath(__file__)), session_store=store, debug=False)
+
+            @route('/save')
+            def save():
+                ctx.response.session.value = object()
+                return 'ok'
+
+            @route('/login')
+            def login():
+                ctx.response.session.value = object()
+                see_other('/')
+            app.add_url(save)
+            app.add_url(login)
+            for path in ('/save', '/login'):
+                r = _call(app, path)
+                self.assertEqual(r['status'], '500 Internal Server Error')
+                self.assertEqual(len(ctx.__storage__), 0)
+            self.assertEqual(len(store), 0)
+        finally:
+            shutil.rmtree(root)
+
+    def testReleaseContext(self):
+        class _Store(MemorySessionStore):
+            def flush(self):
+                raise KeyboardInterrupt()
+        app = Tindo(os.path.dirname(os.path.abspath(__file__)), session_store=_Store())
+        with self.assertRaises(KeyboardInterrupt):
+            _call(app, '/missing')
+        self.assertEqual(len(ctx.__storage__), 0)
+
+    def testDispatchCache(self):
+        self.assertIsNone(self.app.dispatch_cache_info)
+        app = Tindo(os.path.dirname(os.path.abspath(__file__)), dispatch_cache_size=2)
+
+        @route('/user/<name>')
+        def user(name):
+            return name
+        app.add_url(user)
+        for name in ('a', 'a', 'b', 'a'):
+            self.assertEqual(_call(app, '/user/' + name)['body'], name)
+        self.assertEqual(app.dispatch_cache_info, {'hits': 2, 'misses': 2, 'size': 2, 'currsize': 2, 'maxsize': 2})
+
+        @route('/user/admin')
+        def admin():
+            return 'admin'
+        app._running = False
+        app.add_url(admin)
+        self.assertEqual(app.dispatch_cache_info.size, 0)
+        self.assertEqual(_call(app, '/user/admin')['body'], 'admin')
+
+    def testJson(self):
+        app = Tindo(os.path.dirname(os.path.abspath(__file__)), json_encoder=lambda data: repr(sorted(data)))
+
+        @route('/dict')
+        def as_dict():
+            return dict(b=2, a=1)
+
+        @route('/created', methods=['POST'])
+        def created():
+            return JSONResponse([1, 2], status=201)
+        app.add_url(as_dict)
+        app.add_url(created)
+        r = _call(app, '/dict')
+        self.assertEqual(r['body'], "['a', 'b']")
+        self.assertEqual(r['headers']['Content-Type'], 'application/json; charset=utf-8')
+        self.assertEqual(r['headers']['Content-Length'], '10')
+        r = _call(app, '/created', method='POST')
+        self.assertEqual(r['status'], '201 Created')
+        self.assertEqual(r['body'], '[1, 2]')
+
+    def testGzip(self):
+        app = Tindo(os.path.dirname(os.path.abspath(__file__)), gzip=True, gzip_min_size=100)
+
+        @route('/page/<size>')
+        def page(size):
+            return 'x' * int(size)
+        app.add_url(page)
+        r = _call(app, '/page/1000', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(r['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(r['headers']['Vary'], 'Accept-Encoding')
+        self.assertEqual(zlib.decompress(r['body'], 31), 'x' * 1000)
+        r = _call(app, '/page/10', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse('Content-Encoding' in r['headers'])
+        self.assertEqual(r['body'], 'x' * 10)
+        r = _call(app, '/page/1000')
+        self.assertFalse('Content-Encoding' in r['headers'])
+
+    def testContentLength(self):
+        @route('/chunks')
+        def chunks():
+            return ['ab', 'cde']
+
+        @route('/generator')
+        def generator():
+            return (c for c in 'abc')
+        self.app.add_url(chunks)
+        self.app.add_url(generator)
+        self.assertEqual(_call(self.app, '/item/a')['headers']['Content-Length'], '6')
+        self.assertEqual(_call(self.app, '/chunks')['headers']['Content-Length'], '5')
+        r = _call(self.app, '/generator')
+        self.assertEqual(r['body'], 'abc')
+        self.assertFalse('Content-Length' in r['headers'])
+
+    def testWrites(self):
+        @route('/page')
+        def page():
+            return u'\u4e2d' * 10000
+
+        @route('/chunks')
+        def chunks():
+            return ['a'] * 100
+
+        @route('/big')
+        def big():
+            return ['x' * 65536, 'y']
+
+        @route('/generator')
+        def generator():
+            return (c for c in 'abc')
+
+        @route('/error')
+        def error():
+            raise ValueError('error')
+        for fn in (page, chunks, big, generator, error):
+            self.app.add_url(fn)
+
+        def writes(path):
+            return len(list(self.app({'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'wsgi.input': StringIO('')},
+                                     lambda status, headers: None)))
+        self.assertEqual(writes('/page'), 1)
+        self.assertEqual(writes('/chunks'), 1)
+        self.assertEqual(writes('/big'), 2)
+        self.assertEqual(writes('/generator'), 3)
+        self.assertEqual(writes('/missing'), 1)
+        self.assertEqual(writes('/error'), 1)
+        r = _call(self.app, '/error')
+        self.assertEqual(r['status'], '500 Internal Server Error')
+        self.assertTrue('ValueError' in r['body'])
+        self.assertEqual(r['headers']['Content-Length'], str(len(r['body'])))
+
+    def testHead(self):
+        r = _call(self.app, '/item/a', method='HEAD')
+        self.assertEqual(r['status'], '200 OK')
+        self.assertEqual(r['headers']['Content-Length'], str(len('item a')))
+
+        @route('/item/<name>', methods=['HEAD'])
+        def head_item(name):
+            ctx.response.set_header('X-Item', name)
+            return ''
+        self.app._running = False
+        self.app.add_url(head_item)
+        self.assertEqual(_call(self.app, '/item/b', method='HEAD')['headers']['X-Item'], 'b')
+        self.assertEqual(_call(self.app, '/item/new', method='HEAD')['status'], '200 OK')
+
+    def testNotFound(self):
+        self.assertEqual(_call(self.app, '/items')['status'], '404 Not Found')
+        self.assertEqual(_call(self.app, '/item/a', method='POST')['status'], '404 Not Found')
+        self.assertEqual(_call(self.app, '/items', method='HEAD')['status'], '404 Not Found')
+        self.assertEqual(_call(self.app, '/item/a', method='BREW')['status'], '400 Bad Request')
+
+
+class TestStaticFile(unittest.TestCase):
+    def setUp(self):
+        self.root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'example')
+        self.app = Tindo(self.root, static_block_size=16)
+        with open(os.path.join(self.root, 'static', 'style.css'), 'rb') as f:
+            self.content = f.read()
+
+    def testGenerator(self):
+        r = _call(self.app, '/static/style.css')
+        self.assertEqual(r['status'], '200 OK')
+        self.assertEqual(r['headers']['Content-Type'], 'text/css')
+        self.assertEqual(r['headers']['Content-Length'], str(len(self.content)))
+        self.assertEqual(r['body'], self.content)
+
+    def testHead(self):
+        r = _call(self.app, '/static/style.css', method='HEAD')
+        self.assertEqual(r['status'], '200 OK')
+        self.assertEqual(r['headers']['Content-Length'], str(len(self.content)))
+
+    def testTraversal(self):
+        for path in ('/static/../app.py', '/static/../../etc/hostname', '/static/css/../../tindo/tindo.py',
+                     '/static/style.css\0'):
+            self.assertEqual(_call(self.app, path)['status'], '404 Not Found')
+        self.assertEqual(_call(self.app, '/static/./css/../style.css')['status'], '200 OK')
+
+    def testFileWrapper(self):
+        wrapped = []
+
+        def file_wrapper(fp, block_size):
+            wrapped.append(block_size)
+            return iter([fp.read()])
+        r = _call(self.app, '/static/style.css', **{'wsgi.file_wrapper': file_wrapper})
+        self.assertEqual(wrapped, [16])
+        self.assertEqual(r['body'], self.content)
+
+    def testConditional(self):
+        r = _call(self.app, '/static/style.css')
+        etag = r['headers']['ETag']
+        last_modified = r['headers']['Last-Modified']
+        self.assertFalse('Cache-Control' in r['headers'])
+        r = _call(self.app, '/static/style.css', HTTP_IF_NONE_MATCH='"other", %s' % etag)
+        self.assertEqual(r['status'], '304 Not Modified')
+        self.assertEqual(r['body'], '')
+        self.assertFalse('Content-Type' in r['headers'])
+        r = _call(self.app, '/static/style.css', HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(r['status'], '200 OK')
+        r = _call(self.app, '/static/style.css', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(r['status'], '304 Not Modified')
+        r = _call(self.app, '/static/style.css', HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:00:00 GMT')
+        self.assertEqual(r['body'], self.content)
+
+    def testRange(self):
+        r = _call(self.app, '/static/style.css', HTTP_RANGE='bytes=2-9')
+        self.assertEqual(r['status'], '206 Partial Content')
+        self.assertEqual(r['headers']['Content-Range'], 'bytes 2-9/%d' % len(self.content))
+        self.assertEqual(r['headers']['Content-Length'], '8')
+        self.assertEqual(r['body'], self.content[2:10])
+        r = _call(self.app, '/static/style.css', HTTP_RANGE='bytes=0-1,-3')
+        self.assertEqual(r['status'], '206 Partial Content')
+        content_type = r['headers']['Content-Type']
+        self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+        self.assertEqual(r['headers']['Content-Length'], str(len(r['body'])))
+        self.assertTrue(self.content[:2] in r['body'])
+        self.assertTrue(r['body'].endswith('\r\n--%s--\r\n' % content_type.split('=')[1]))
+        r = _call(self.app, '/static/style.css', HTTP_RANGE='bytes=9999-')
+        self.assertEqual(r['status'], '416 Requested Range Not Satisfiable')
+        self.assertEqual(r['headers']['Content-Range'], 'bytes */%d' % len(self.content))
+        r = _call(self.app, '/static/style.css', HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(r['status'], '200 OK')
+        self.assertEqual(r['headers']['Accept-Ranges'], 'bytes')
+
+    def testCache(self):
+        self.assertIsNone(self.app.static_cache_info)
+        app = Tindo(self.root, static_cache_size=1024, static_cache_check_interval=0)
+        for _ in range(3):
+            r = _call(app, '/static/style.css')
+            self.assertEqual(r['body'], self.content)
+            self.assertEqual(r['headers']['Content-Length'], str(len(self.content)))
+        info = app.static_cache_info
+        self.assertEqual((info.hits, info.misses, info.currsize), (2, 1, len(self.content)))
+        r = _call(app, '/static/style.css', HTTP_RANGE='bytes=1-2')
+        self.assertEqual(r['body'], self.content[1:3])
+        cache = app._static_file_route.cache
+        file_path = os.path.join(self.root, 'static/style.css')
+        cache.get(file_path).mtime = 0
+        self.assertEqual(_call(app, '/static/style.css')['body'], self.content)
+        self.assertNotEqual(cache.get(file_path).mtime, 0)
+
+    def testGzip(self):
+        app = Tindo(self.root, gzip=True, gzip_min_size=16)
+        r = _call(app, '/static/style.css', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(r['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(r['headers']['Vary'], 'Accept-Encoding')
+        self.assertEqual(r['headers']['Content-Length'], str(len(r['body'])))
+        self.assertTrue(r['headers']['ETag'].endswith('-gzip"'))
+        self.assertEqual(zlib.decompress(r['body'], 31), self.content)
+        r = _call(app, '/static/style.css')
+        self.assertFalse('Content-Encoding' in r['headers'])
+        self.assertEqual(r['headers']['Vary'], 'Accept-Encoding')
+        self.assertEqual(r['body'], self.content)
+        r = _call(app, '/static/style.css', HTTP_ACCEPT_ENCODING='gzip', HTTP_RANGE='bytes=99999-')
+        self.assertEqual(r['status'], '416 Requested Range Not Satisfiable')
+        self.assertFalse('Content-Encoding' in r['headers'])
+
+    def testPrecompressed(self):
+        import shutil
+        import tempfile
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root, 'static'))
+            with open(os.path.join(root, 'static', 'app.js'), 'wb') as f:
+                f.write('var a = 1;')
+            with open(os.path.join(root, 'static', 'app.js.gz'), 'wb') as f:
+                f.write('precompressed')
+            app = Tindo(root, gzip=True)
+            r = _call(app, '/static/app.js', HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(r['body'], 'precompressed')
+            self.assertEqual(r['headers']['Content-Encoding'], 'gzip')
+            self.assertEqual(r['headers']['Content-Type'], 'application/javascript')
+            self.assertEqual(_call(app, '/static/app.js')['body'], 'var a = 1;')
+        finally:
+            shutil.rmtree(root)
+
+    def testMaxAge(self):
+        app = Tindo(self.root, static_max_age=3600)
+        r = _call(app, '/static/style.css')
+        self.assertEqual(r['headers']['Cache-Control'], 'public, max-age=3600')
+
+    def testNotFound(self):
+        self.assertEqual(_call(self.app, '/static/missing.css')['status'], '404 Not Found')
+        self.assertEqual(_call(self.app, '/static/')['status'], '404 Not Found')
+
+
+class TestTemplate(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'templates'))
+        os.mkdir(os.path.join(self.root, 'cache'))
+        for name, content in (('index.html', '<p>{{ name }}</p>'), ('other.html', '{{ 1 + 1 }}')):
+            with open(os.path.join(self.root, 'templates', name), 'wb') as f:
+                f.write(content)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root)
+
+    def testPrecompile(self):
+        app = Tindo(self.root, debug=False, template_cache_dir=os.path.join(self.root, 'cache'))
+
+        @view('index.html')
+        @route('/')
+        def index():
+            return dict(name='tindo')
+        app.add_url(index)
+        self.assertEqual(_call(app, '/')['body'], '<p>tindo</p>')
+        self.assertEqual(len(os.listdir(os.path.join(self.root, 'cache'))), 2)
+        os.remove(os.path.join(self.root, 'templates', 'index.html'))
+        self.assertEqual(_call(app, '/')['body'], '<p>tindo</p>')
+
+    def testPrecompileErrors(self):
+        for name, content in (('broken.html', '{% if %}'), ('index.html~', '{% if %}'), ('logo.png', '\x89PNG\xff')):
+            with open(os.path.join(self.root, 'templates', name), 'wb') as f:
+                f.write(content)
+        app = Tindo(self.root, debug=False)
+
+        @view('index.html')
+        @route('/')
+        def index():
+            return dict(name='tindo')
+
+        @view('broken.html')
+        @route('/broken')
+        def broken():
+            return dict()
+        app.add_url(index)
+        app.add_url(broken)
+        self.assertEqual(app.precompile_templates(), 2)
+        self.assertEqual(_call(app, '/')['body'], '<p>tindo</p>')
+        self.assertEqual(_call(app, '/broken')['status'], '500 Internal Server Error')
+
+    def testStream(self):
+        with open(os.path.join(self.root, 'templates', 'list.html'), 'wb') as f:
+            f.write('{% for i in items %}<li>{{ i }}</li>{% endfor %}')
+        app = Tindo(self.root)
+
+        @view('list.html', stream=True, buffer_size=20)
+        @route('/list')
+        def items():
+            return dict(items=range(10))
+        app.add_url(items)
+        body = app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/list', 'wsgi.input': StringIO('')},
+                   lambda status, headers: None)
+        chunks = list(body)
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(''.join(chunks), ''.join('<li>%d</li>' % i for i in range(10)))
+        r = _call(app, '/list')
+        self.assertFalse('Content-Length' in r['headers'])
+
+    def testViewCache(self):
+        app = Tindo(self.root)
+        calls = []
+
+        @view('index.html', cache_ttl=60)
+        @route('/user/<name>')
+        def user(name):
+            calls.append(name)
+            if name == 'cookie':
+                ctx.response.set_cookie('seen', '1')
+            return dict(name=name)
+
+        @view('other.html', cache_ttl=60, cache_key=lambda model: 'all')
+        @route('/other/<name>')
+        def other(name):
+            return dict(name=name)
+        app.add_url(user)
+        app.add_url(other)
+        for name in ('a', 'a', 'b', 'a'):
+            self.assertEqual(_call(app, '/user/' + name)['body'], '<p>%s</p>' % name)
+        self.assertEqual(calls, ['a', 'a', 'b', 'a'])
+        self.assertEqual(app.view_cache_info.hits, 2)
+        with open(os.path.join(self.root, 'templates', 'index.html'), 'wb') as f:
+            f.write('<h1>{{ name }}</h1>')
+        self.assertEqual(_call(app, '/user/a')['body'], '<p>a</p>')
+        _call(app, '/other/a')
+        _call(app, '/other/b')
+        self.assertEqual(app.view_cache_info.size, 3)
+        app.invalidate_view('index.html', key=None)
+        self.assertEqual(app.view_cache_info.size, 1)
+        self.assertEqual(_call(app, '/user/a')['body'], '<h1>a</h1>')
+        app.invalidate_view('other.html', 'all')
+        app.invalidate_view()
+        self.assertEqual(app.view_cache_info.size, 0)
+        _call(app, '/user/cookie')
+        _call(app, '/user/cookie')
+        self.assertEqual(app.view_cache_info.size, 0)
+
+    def testViewCacheObjects(self):
+        app = Tindo(self.root)
+
+        class User(object):
+            def __init__(self, name):
+                self.name = name
+
+            def __repr__(self):
+                return '<User>'
+        current = [User('alice')]
+
+        @view('index.html', cache_ttl=60)
+        @route('/me')
+        def me():
+            return dict(name=current[0].name, user=current[0])
+        app.add_url(me)
+        self.assertEqual(_call(app, '/me')['body'], '<p>alice</p>')
+        current[0] = User('bob')
+        self.assertEqual(_call(app, '/me')['body'], '<p>bob</p>')
+        self.assertEqual(app.view_cache_info.size, 0)
+        with self.assertRaises(ValueError):
+            view('index.html', stream=True, cache_ttl=60)
+
+    def testDebug(self):
+        app = Tindo(self.root)
+        self.assertEqual(app.precompile_templates(), 2)
+        self.assertEqual(app.template_engine('index.html', dict(name='<b>')), '<p>&lt;b&gt;</p>')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,10 @@
-from .local import Local
-from .utils import Dict, UTC
+from .local import Local, release_local, set_ident_func
+from .utils import Dict, UTC, LRUCache
+from .session import Session, SessionStore, MemorySessionStore, SignedCookieSessionStore, SQLiteSessionStore
+from .server import PreforkServer, ThreadPoolServer
+from .metrics import Metrics
 from .http import HttpError, RedirectError, bad_request, unauthorized, forbidden, RE_RESPONSE_STATUS
 from .http import internal_error, redirect, found, see_other
 from .http import to_str, to_unicode, quote, unquote, RESPONSE_STATUSES
 from .tindo import Tindo, get, post, Request, Response, route
-from .tindo import view, ctx
\ No newline at end of file
+from .tindo import view, ctx, JSONResponse
\ No newline at end of file
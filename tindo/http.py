@@ -4,6 +4,7 @@ some http errors
 """
 import re
 import urllib
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
 
 RE_RESPONSE_STATUS = re.compile(r'^\d\d\d\s.*$')
@@ -231,3 +232,120 @@ def unquote(s, encoding='utf-8'):
     :return: str type
     """
     return urllib.unquote(s).decode(encoding)
+
+
+def http_date(timestamp):
+    """
+    format the timestamp as HTTP date
+    :param timestamp: seconds since the epoch
+    :return: str such as 'Sat, 14 Jul 2012 14:06:34 GMT'
+    """
+    return formatdate(timestamp, usegmt=True)
+
+
+def parse_http_date(value):
+    """
+    parse HTTP date to timestamp
+    :param value: HTTP date
+    :return: seconds since the epoch, None if it is invalid
+    """
+    t = parsedate_tz(value)
+    if t is None:
+        return None
+    return mktime_tz(t)
+
+
+def parse_range_header(value, size, max_ranges=64):
+    """
+    parse the Range header of request for a resource of size bytes
+    'bytes=0-499,-500' => [(0, 500), (size-500, size)]
+    :param value: the Range header
+    :param size: the size of resource
+    :param max_ranges: the header is ignored if it asks for more ranges
+    :return: a list of (start, stop), [] if no range is satisfiable,
+             None if the header is invalid and should be ignored
+    """
+    unit, _, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = specs.split(',')
+    if len(specs) > max_ranges:
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix > 0 and size > 0:
+                    ranges.append((max(size - suffix, 0), size))
+                continue
+            start = int(first)
+            stop = int(last) + 1 if last else None
+        except ValueError:
+            return None
+        if start < 0 or (stop is not None and stop <= start):
+            return None
+        if start < size:
+            ranges.append((start, size if stop is None else min(stop, size)))
+    return ranges
+
+
+def accepts_encoding(value, coding):
+    """
+    whether the Accept-Encoding header accepts the content coding
+    'gzip, deflate;q=0.5' => accepts 'gzip' and 'deflate'
+    :param value: the Accept-Encoding header
+    :param coding: the content coding such as 'gzip'
+    :return: bool
+    """
+    if not value:
+        return False
+    star = False
+    for item in value.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        q = 1.0
+        for param in params.split(';'):
+            k, _, v = param.partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if name == coding:
+            return q > 0
+        if name == '*':
+            star = q > 0
+    return star
+
+
+def parse_qs(qs, encoding='utf-8'):
+    """
+    parse query string, the blank values are kept.
+    'a=1&c=ABC&c=XYZ' => {'a': u'1', 'c': [u'ABC', u'XYZ']}
+    :param qs: the query string
+    :param encoding: encoding type
+    :return: dict whose value is unicode, or list of unicode for multiple values
+    """
+    inputs = {}
+    for pair in qs.split('&'):
+        if not pair:
+            continue
+        key, _, value = pair.partition('=')
+        if '%' in key or '+' in key:
+            key = urllib.unquote_plus(key)
+        if '%' in value or '+' in value:
+            value = urllib.unquote_plus(value)
+        value = value.decode(encoding)
+        if key not in inputs:
+            inputs[key] = value
+        elif isinstance(inputs[key], list):
+            inputs[key].append(value)
+        else:
+            inputs[key] = [inputs[key], value]
+    return inputs
@@ -5,17 +5,43 @@
 """
 
 from thread import get_ident
+from utils import Dict
+
+try:
+    from greenlet import getcurrent as greenlet_ident
+except ImportError:
+    greenlet_ident = None
 
 
 class Local(object):
     """
-    The local object behave like thread.local
+    The local object behave like thread.local. The context is identified by
+    ident_func, which is thread.get_ident by default, greenlet_ident makes it
+    greenlet-local.
     """
     __slots__ = ('__storage__', '__ident_func__')
 
-    def __init__(self):
+    def __init__(self, ident_func=None):
         object.__setattr__(self, '__storage__', {})
-        object.__setattr__(self, '__ident_func__', get_ident)
+        object.__setattr__(self, '__ident_func__', get_ident if ident_func is None else ident_func)
+
+    def __call__(self):
+        """
+        Get the storage of current context as Dict, which saves the ident
+        lookup of each access when it is used many times.
+        c = ctx()
+        c.request ==> ctx.request
+        """
+        ident = self.__ident_func__()
+        storage = self.__storage__
+        try:
+            return storage[ident]
+        except KeyError:
+            d = storage[ident] = Dict()
+            return d
+
+    def __release_local__(self):
+        self.__storage__.pop(self.__ident_func__(), None)
 
     def __getattr__(self, name):
         try:
@@ -29,10 +55,26 @@ class Local(object):
         try:
             storage[ident][name] = value
         except KeyError:
-            storage[ident] = {name: value}
+            storage[ident] = Dict()
+            storage[ident][name] = value
 
     def __delattr__(self, name):
         try:
             del self.__storage__[self.__ident_func__()][name]
         except KeyError:
             raise AttributeError(name)
+
+
+def release_local(local):
+    """
+    Release the storage of current context, which should be called when a
+    request ends so the storage does not leak.
+    """
+    local.__release_local__()
+
+
+def set_ident_func(local, ident_func):
+    """
+    Change how the context of local is identified, such as greenlet_ident.
+    """
+    object.__setattr__(local, '__ident_func__', ident_func)
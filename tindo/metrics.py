@@ -0,0 +1,211 @@
+# -*- coding:utf-8 -*-
+"""
+    tindo.metrics
+    The timing of requests, exposed in the text format of Prometheus.
+"""
+import time
+import types
+import bisect
+import threading
+from utils import Dict
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PHASES = ('dispatch', 'handler', 'render', 'body')
+
+
+class _Histogram(object):
+    """
+    The counts of observed values in each bucket, the last one is +Inf.
+    """
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * (size + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def cumulative(self):
+        total = 0
+        result = []
+        for n in self.counts:
+            total += n
+            result.append(total)
+        return result
+
+
+class _Timer(object):
+    """
+    The timing of one request, each lap is the seconds spent by a phase.
+    """
+    __slots__ = ('_metrics', '_start_response', 'method', 'route', 'status', 'start', 'last', 'phases')
+
+    def __init__(self, metrics, method, start_response):
+        self._metrics = metrics
+        self._start_response = start_response
+        self.method = method
+        self.route = None
+        self.status = None
+        self.start = self.last = time.time()
+        self.phases = []
+
+    def start_response(self, status, headers, *args):
+        self.status = status[:3]
+        return self._start_response(status, headers, *args)
+
+    def lap(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def finish(self):
+        self.lap('body')
+        self._metrics.record(self)
+
+    def body(self, body, file_wrapper=None):
+        """
+        the request is recorded when body has been sent. The body made by
+        wsgi.file_wrapper is returned as it is, so the server still sends it
+        by sendfile, and the request is recorded before it is sent.
+        """
+        wrapped = isinstance(file_wrapper, (type, types.ClassType)) and isinstance(body, file_wrapper)
+        if wrapped or isinstance(body, list):
+            self.finish()
+            return body
+        return _TimedBody(body, self)
+
+
+class _TimedBody(object):
+    def __init__(self, body, timer):
+        self._body = body
+        self._timer = timer
+
+    def __iter__(self):
+        return iter(self._body)
+
+    def close(self):
+        try:
+            close = getattr(self._body, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._timer.finish()
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metrics(object):
+    """
+    Record the latency histogram of every route and its phases (dispatch,
+    handler, render and body), the count of every status code and the number
+    of requests in flight. A request takes the lock twice, when it starts
+    and when it is recorded.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._phases = dict((phase, _Histogram(len(self.buckets))) for phase in PHASES)
+        self._statuses = {}
+        self.in_flight = 0
+
+    def timer(self, method, start_response):
+        """
+        start timing a request.
+        :param method: the HTTP method
+        :param start_response: the start_response of WSGI, which is wrapped
+                               to get the status
+        :return: the timer
+        """
+        with self._lock:
+            self.in_flight += 1
+        return _Timer(self, method, start_response)
+
+    def _observe(self, histogram, value):
+        histogram.counts[bisect.bisect_left(self.buckets, value)] += 1
+        histogram.sum += value
+        histogram.count += 1
+
+    def record(self, timer):
+        """
+        record a finished request.
+        """
+        elapsed = timer.last - timer.start
+        key = (timer.method, timer.route or 'unmatched')
+        status = timer.status or '500'
+        with self._lock:
+            self.in_flight -= 1
+            self._statuses[status] = self._statuses.get(status, 0) + 1
+            histogram = self._routes.get(key)
+            if histogram is None:
+                histogram = self._routes[key] = _Histogram(len(self.buckets))
+            self._observe(histogram, elapsed)
+            for phase, seconds in timer.phases:
+                self._observe(self._phases[phase], seconds)
+
+    def _info(self, histogram):
+        counts = histogram.cumulative()
+        return Dict(count=histogram.count, sum=histogram.sum,
+                    buckets=zip(self.buckets + (float('inf'),), counts))
+
+    @property
+    def info(self):
+        """
+        a snapshot of the metrics, the buckets of a histogram are pairs of
+        (upper bound, cumulative count).
+        """
+        with self._lock:
+            return Dict(in_flight=self.in_flight,
+                        statuses=dict((int(k), v) for k, v in self._statuses.iteritems()),
+                        routes=dict(('%s %s' % key, self._info(h)) for key, h in self._routes.iteritems()),
+                        phases=dict((phase, self._info(h)) for phase, h in self._phases.iteritems()))
+
+    def _render_histogram(self, lines, name, labels, histogram):
+        les = [_format_number(b) for b in self.buckets] + ['+Inf']
+        for le, count in zip(les, histogram.cumulative()):
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, le, count))
+        labels = labels.rstrip(',')
+        labels = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %s' % (name, labels, _format_number(histogram.sum)))
+        lines.append('%s_count%s %d' % (name, labels, histogram.count))
+
+    def render(self, gauges=()):
+        """
+        render the metrics in the text format of Prometheus.
+        :param gauges: other samples as (name, type, help, value)
+        :return: str
+        """
+        lines = []
+        with self._lock:
+            lines.append('# HELP tindo_request_duration_seconds The seconds spent by requests.')
+            lines.append('# TYPE tindo_request_duration_seconds histogram')
+            for (method, route), histogram in sorted(self._routes.iteritems()):
+                labels = 'method="%s",route="%s",' % (_escape(method), _escape(route))
+                self._render_histogram(lines, 'tindo_request_duration_seconds', labels, histogram)
+            lines.append('# HELP tindo_phase_duration_seconds The seconds spent by each phase of requests.')
+            lines.append('# TYPE tindo_phase_duration_seconds histogram')
+            for phase in PHASES:
+                self._render_histogram(lines, 'tindo_phase_duration_seconds', 'phase="%s",' % phase,
+                                       self._phases[phase])
+            lines.append('# HELP tindo_responses_total The responses of each status code.')
+            lines.append('# TYPE tindo_responses_total counter')
+            for status, count in sorted(self._statuses.iteritems()):
+                lines.append('tindo_responses_total{status="%s"} %d' % (status, count))
+            lines.append('# HELP tindo_requests_in_flight The requests being served.')
+            lines.append('# TYPE tindo_requests_in_flight gauge')
+            lines.append('tindo_requests_in_flight %d' % self.in_flight)
+        for name, kind, description, value in gauges:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %s' % (name, _format_number(value)))
+        lines.append('')
+        return '\n'.join(lines)
@@ -0,0 +1,141 @@
+# -*- coding:utf-8 -*-
+"""
+    tindo.multipart
+    A streaming parser of multipart/form-data request body.
+"""
+import cgi
+import tempfile
+from http import HttpError
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class MultipartPart(object):
+    """
+    A file part of multipart body, whose content is spooled to a temporary
+    file once it grows above the spool threshold.
+    """
+    def __init__(self, name, filename, content_type, headers, fp):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.headers = headers
+        self.file = fp
+
+    def __str__(self):
+        return '(MultipartPart, name=%s, filename=%s)' % (self.name, self.filename)
+
+    __repr__ = __str__
+
+
+def _parse_part_headers(block):
+    headers = {}
+    for line in block.split('\r\n'):
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise MultipartError('Bad part header: %r' % line)
+        headers[name.strip().upper()] = value.strip()
+    return headers
+
+
+def parse_multipart(chunks, boundary, charset='utf-8', spool_threshold=1048576,
+                    max_part_size=None, max_fields=None, max_header_size=8192, max_field_size=1048576):
+    """
+    parse multipart/form-data body chunk by chunk.
+    :param chunks: an iterable of the body chunks
+    :param boundary: the boundary of Content-Type
+    :param charset: the charset of field values
+    :param spool_threshold: file parts above it are spooled to temporary file
+    :param max_part_size: raise 413 if a part is larger
+    :param max_fields: raise 413 if there are more parts
+    :param max_header_size: the max size of the headers of one part
+    :param max_field_size: raise 413 if a part which is not a file is larger,
+                           since it is kept in memory
+    :return: a list of (name, value), value is unicode or MultipartPart
+    """
+    delimiter = '--' + boundary
+    body_delimiter = '\r\n' + delimiter
+    keep = len(body_delimiter) - 1
+    chunks = iter(chunks)
+
+    def _fill(buf):
+        for chunk in chunks:
+            if chunk:
+                return buf + chunk
+        raise MultipartError('Unexpected end of multipart body')
+
+    buf = ''
+    while True:
+        i = buf.find(delimiter)
+        if i >= 0:
+            buf = buf[i + len(delimiter):]
+            break
+        buf = _fill(buf[-keep:])
+
+    fields = []
+    while True:
+        while len(buf) < 2:
+            buf = _fill(buf)
+        if buf[:2] == '--':
+            return fields
+        if buf[:2] != '\r\n':
+            raise MultipartError('Bad multipart delimiter')
+        buf = buf[2:]
+
+        while True:
+            i = buf.find('\r\n\r\n')
+            if i >= 0:
+                break
+            if len(buf) > max_header_size:
+                raise MultipartError('Part headers are too large')
+            buf = _fill(buf)
+        headers = _parse_part_headers(buf[:i]) if i else {}
+        buf = buf[i + 4:]
+        if max_fields is not None and len(fields) >= max_fields:
+            raise HttpError(413)
+        disposition, params = cgi.parse_header(headers.get('CONTENT-DISPOSITION', ''))
+        name = params.get('name')
+        if disposition != 'form-data' or name is None:
+            raise MultipartError('Bad Content-Disposition of part')
+        filename = params.get('filename')
+        max_size = max_part_size
+        if filename is not None:
+            fp = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+            write = fp.write
+        else:
+            fp = None
+            values = []
+            write = values.append
+            if max_field_size is not None and (max_size is None or max_field_size < max_size):
+                max_size = max_field_size
+
+        size = 0
+        while True:
+            i = buf.find(body_delimiter)
+            if i >= 0:
+                data, buf = buf[:i], buf[i + len(body_delimiter):]
+            elif len(buf) > keep:
+                data, buf = buf[:-keep], buf[-keep:]
+            else:
+                data = ''
+            if data:
+                size += len(data)
+                if max_size is not None and size > max_size:
+                    if fp is not None:
+                        fp.close()
+                    raise HttpError(413)
+                write(data)
+            if i >= 0:
+                break
+            buf = _fill(buf)
+
+        if fp is not None:
+            fp.seek(0)
+            fields.append((name, MultipartPart(name, filename, headers.get('CONTENT-TYPE'), headers, fp)))
+        else:
+            try:
+                fields.append((name, ''.join(values).decode(charset)))
+            except UnicodeError:
+                raise MultipartError('Bad encoding of field %s' % name)
@@ -0,0 +1,786 @@
+# -*- coding:utf-8 -*-
+"""
+    tindo.server
+    A pre-forking HTTP/1.1 WSGI server for production.
+"""
+import os
+import sys
+import time
+import errno
+import signal
+import select
+import socket
+import urllib
+import logging
+import threading
+import multiprocessing
+import BaseHTTPServer
+from Queue import Queue, Full
+from http import RESPONSE_STATUSES, http_date
+from utils import Dict
+
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+
+def _select(rlist, timeout):
+    """
+    get the readable ones of rlist, nothing if select is interrupted.
+    """
+    try:
+        return select.select(rlist, [], [], timeout)[0]
+    except select.error as e:
+        if e.args[0] == errno.EINTR:
+            return []
+        raise
+
+
+class _InputStream(object):
+    """
+    wsgi.input which stops at Content-Length, so that the next request on
+    a kept-alive connection is not read by the application.
+    """
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return ''
+        data = self._rfile.read(size)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return ''
+        data = self._rfile.readline(size)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def drain(self, max_size):
+        """
+        skip the unread body up to max_size bytes.
+        :return: whether the whole body has been read
+        """
+        while 0 < self.remaining <= max_size:
+            if not self.read(65536):
+                break
+        return self.remaining == 0
+
+
+class FileWrapper(object):
+    """
+    wsgi.file_wrapper of the servers. The file is sent by sendfile() when the
+    pysendfile package is installed, otherwise it is read in blocks of blksize.
+    """
+    def __init__(self, filelike, blksize=65536):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        while True:
+            data = self.filelike.read(self.blksize)
+            if not data:
+                return
+            yield data
+
+
+class WSGIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handle the HTTP/1.1 requests of one connection by the WSGI application of
+    the server. Reading and writing time out after the timeout of the server,
+    and the connection is kept alive for keepalive_timeout seconds between
+    requests. A response without Content-Length is sent chunked.
+    """
+    protocol_version = 'HTTP/1.1'
+    server_version = 'Tindo'
+    max_drain_size = 1048576
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.settimeout(self.server.timeout)
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self._wait_request():
+                break
+            self.handle_one_request()
+
+    def _wait_request(self):
+        """
+        wait for the next request on a kept-alive connection.
+        """
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        if rbuf is not None and rbuf.tell():
+            return True
+        return self.server.wait_request(self.connection)
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.error:
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        if self.headers.get('Transfer-Encoding', '').lower() not in ('', 'identity'):
+            self.send_error(411)
+            self.close_connection = 1
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400)
+            self.close_connection = 1
+            return
+        stream = _InputStream(self.rfile, length)
+        self.server.request_started()
+        start = time.time()
+        self._run_app(self._environ(stream))
+        elapsed = time.time() - start
+        if not stream.drain(self.max_drain_size):
+            self.close_connection = 1
+        if not self.server.request_done(elapsed):
+            self.close_connection = 1
+
+    def _environ(self, stream):
+        path, _, query = self.path.partition('?')
+        server = self.server
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': server.server_name,
+            'SERVER_PORT': str(server.server_port),
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': stream,
+            'wsgi.errors': sys.stderr,
+            'wsgi.file_wrapper': FileWrapper,
+            'wsgi.multithread': server.multithread,
+            'wsgi.multiprocess': server.multiprocess,
+            'wsgi.run_once': False,
+        }
+        for name, value in self.headers.items():
+            name = name.upper().replace('-', '_')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            else:
+                environ['HTTP_' + name] = value
+        return environ
+
+    def _run_app(self, environ):
+        self._status = None
+        self._response_headers = None
+        self._headers_sent = False
+        self._chunked = False
+        try:
+            result = self.server.app(environ, self._start_response)
+            try:
+                if isinstance(result, FileWrapper) and sendfile is not None and \
+                        hasattr(result.filelike, 'fileno'):
+                    self._write('')
+                    if not self._chunked and self.command != 'HEAD':
+                        self._send_file(result)
+                        result = ()
+                for data in result:
+                    if data:
+                        self._write(data)
+                if not self._headers_sent:
+                    self._write('')
+                if self._chunked:
+                    self.wfile.write('0\r\n\r\n')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except socket.error:
+            self.close_connection = 1
+        except Exception:
+            logging.exception('error of %s %s' % (self.command, self.path))
+            self.close_connection = 1
+            if not self._headers_sent:
+                self._status = '500 %s' % RESPONSE_STATUSES[500]
+                self._response_headers = [('Content-Type', 'text/plain'), ('Content-Length', '0')]
+                try:
+                    self._write('')
+                except socket.error:
+                    pass
+
+    def _send_file(self, wrapper):
+        """
+        send the rest of the file of wrapper by sendfile().
+        """
+        out_fd = self.connection.fileno()
+        in_fd = wrapper.filelike.fileno()
+        offset = wrapper.filelike.tell()
+        while True:
+            try:
+                sent = sendfile(out_fd, in_fd, offset, wrapper.blksize)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    if not select.select([], [self.connection], [], self.server.timeout)[1]:
+                        raise socket.timeout('timed out')
+                    continue
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not sent:
+                return
+            offset += sent
+
+    def _start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self._headers_sent:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                exc_info = None
+        elif self._status is not None:
+            raise AssertionError('start_response is called twice')
+        self._status = status
+        self._response_headers = headers
+        return self._write
+
+    def _head(self):
+        has_length = False
+        lines = ['%s %s\r\n' % (self.protocol_version, self._status)]
+        for name, value in self._response_headers:
+            lname = name.lower()
+            if lname == 'content-length':
+                has_length = True
+            elif lname == 'connection' and value.lower() == 'close':
+                self.close_connection = 1
+            lines.append('%s: %s\r\n' % (name, value))
+        lines.append('Date: %s\r\n' % http_date(time.time()))
+        if not has_length and self.command != 'HEAD' and self._status[:3] not in ('204', '304'):
+            if self.request_version == 'HTTP/1.1':
+                self._chunked = True
+                lines.append('Transfer-Encoding: chunked\r\n')
+            else:
+                self.close_connection = 1
+        if not self.server.alive:
+            self.close_connection = 1
+        if self.close_connection:
+            lines.append('Connection: close\r\n')
+        elif self.request_version != 'HTTP/1.1':
+            lines.append('Connection: keep-alive\r\n')
+        lines.append('\r\n')
+        return ''.join(lines)
+
+    def _write(self, data):
+        if self._status is None:
+            raise AssertionError('write() before start_response()')
+        head = ''
+        if not self._headers_sent:
+            head = self._head()
+            self._headers_sent = True
+        if self.command == 'HEAD':
+            data = ''
+        elif self._chunked and data:
+            data = '%x\r\n%s\r\n' % (len(data), data)
+        data = head + data
+        if data:
+            self.wfile.write(data)
+
+    def log_request(self, code='-', size='-'):
+        logging.debug('%s "%s" %s' % (self.client_address[0], self.requestline, code))
+
+    def log_message(self, format, *args):
+        logging.info('%s %s' % (self.client_address[0], format % args))
+
+
+def _rss():
+    """
+    the current resident set size of current process in bytes, None if it
+    cannot be read without /proc, since getrusage only gives the peak one.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class _BaseServer(object):
+    """
+    The common part of the servers, which serve the connections accepted on
+    a listening socket by WSGIRequestHandler.
+    """
+    multithread = False
+    multiprocess = False
+    reuse_port = False
+
+    def __init__(self, app, host, port, keepalive_timeout, backlog, timeout):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.backlog = backlog
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.socket = None
+        self.alive = True
+        self.requests = 0
+
+    def bind(self, listen=True):
+        """
+        create the listening socket of the server.
+        :param listen: whether to listen on it, the master only reserves the
+                       port when the workers bind their own sockets
+        """
+        sock = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        self.port = self.server_port = sock.getsockname()[1]
+        if listen:
+            sock.listen(self.backlog)
+            sock.setblocking(0)
+        return sock
+
+    def _accept(self, sock):
+        """
+        accept a connection when sock is readable.
+        :return: (connection, address), None if there is no connection
+        """
+        try:
+            return sock.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED, errno.EINTR):
+                return None
+            raise
+
+    def _handle(self, conn, address):
+        try:
+            WSGIRequestHandler(conn, address, self)
+        except Exception:
+            logging.exception('error of connection from %s' % address[0])
+        finally:
+            try:
+                conn.close()
+            except socket.error:
+                pass
+
+    def request_started(self):
+        """
+        called by the handler before every request.
+        """
+        self.requests += 1
+
+    def request_done(self, elapsed):
+        """
+        called by the handler after every request.
+        :param elapsed: the seconds spent by the application
+        :return: whether the connection can be kept alive
+        """
+        return self.alive
+
+    def wait_request(self, conn):
+        """
+        wait for the next request on a kept-alive connection.
+        :return: whether conn is readable before keepalive_timeout
+        """
+        deadline = time.time() + self.keepalive_timeout
+        while self.alive:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return False
+            if _select([conn], timeout):
+                return True
+        return False
+
+
+class PreforkServer(_BaseServer):
+    """
+    Pre-fork workers which serve the WSGI application, each worker handles
+    one connection at a time.
+    The workers accept on one socket bound by the master. With reuse_port
+    (SO_REUSEPORT, Linux 3.9+), every worker binds its own socket and the
+    kernel balances the connections between them instead, but connections
+    still queued on the socket of a stopping worker are reset.
+    A worker is replaced after max_requests requests or when its RSS grows
+    above max_rss bytes, which is ignored where /proc is missing. SIGHUP restarts all workers gracefully, which are
+    forked from the master again, so the code and templates are not reloaded
+    and the master must be restarted for them. SIGTERM and SIGINT stop the
+    server, a stopping worker finishes its current request and is killed
+    after graceful_timeout seconds. A connection times out after timeout
+    seconds without reading or writing.
+    """
+    multiprocess = True
+
+    def __init__(self, app, host='127.0.0.1', port=9000, workers=None, max_requests=None,
+                 max_rss=None, keepalive_timeout=2.0, backlog=1024, reuse_port=False,
+                 graceful_timeout=30, timeout=30):
+        super(PreforkServer, self).__init__(app, host, port, keepalive_timeout, backlog, timeout)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_requests = max_requests
+        if max_rss is not None and _rss() is None:
+            logging.warning('max_rss is ignored since the RSS of process cannot be read')
+            max_rss = None
+        self.max_rss = max_rss
+        self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        self.graceful_timeout = graceful_timeout
+        self._master_pid = None
+        self._children = {}
+        self._generation = 0
+        self._signals = []
+
+    def request_started(self):
+        """
+        the last request of the worker is answered with 'Connection: close'.
+        """
+        self.requests += 1
+        if self.max_requests is not None and self.requests >= self.max_requests:
+            self.alive = False
+
+    def request_done(self, elapsed):
+        if self.alive and self.max_rss is not None and _rss() > self.max_rss:
+            logging.info('worker %d uses more than %d bytes, restarting' % (os.getpid(), self.max_rss))
+            self.alive = False
+        return self.alive
+
+    def wait_request(self, conn):
+        """
+        the kept-alive connection is given up when a new connection is waiting,
+        so idle clients do not hold the worker.
+        """
+        deadline = time.time() + self.keepalive_timeout
+        while self.alive:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return False
+            r = _select([conn, self.socket], timeout)
+            if conn in r:
+                return True
+            if r:
+                return False
+        return False
+
+    def serve_worker(self, sock):
+        """
+        accept and serve connections on sock until the worker stops.
+        """
+        self.socket = sock
+        while self.alive:
+            r = _select([sock], 1.0)
+            if self._master_pid is not None and os.getppid() != self._master_pid:
+                break
+            if not r:
+                continue
+            accepted = self._accept(sock)
+            if accepted is not None:
+                self._handle(*accepted)
+
+    def _stop_worker(self, signum, frame):
+        self.alive = False
+
+    def _run_worker(self, sock):
+        status = 0
+        try:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, self._stop_worker)
+            signal.signal(signal.SIGINT, self._stop_worker)
+            if sock is None:
+                sock = self.bind()
+            self.serve_worker(sock)
+        except Exception:
+            logging.exception('worker %d failed' % os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _spawn(self, sock):
+        if self.reuse_port:
+            sock = None
+        pid = os.fork()
+        if pid == 0:
+            self._children = {}
+            self._run_worker(sock)
+        self._children[pid] = self._generation
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            self._children.pop(pid, None)
+
+    def _kill(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def stop(self):
+        """
+        stop the workers gracefully, kill them after graceful_timeout.
+        """
+        self._kill(list(self._children), signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self._children and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        self._kill(list(self._children), signal.SIGKILL)
+        self._reap()
+
+    def serve_forever(self):
+        """
+        run the master process which keeps the workers running.
+        """
+        self._master_pid = os.getpid()
+        sock = self.bind(listen=not self.reuse_port)
+        logging.info('serving on %s:%s with %d workers' % (self.host, self.server_port, self.workers))
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._signal)
+        try:
+            while True:
+                self._reap()
+                if self._signals:
+                    signum = self._signals.pop(0)
+                    if signum != signal.SIGHUP:
+                        break
+                    logging.info('restarting workers')
+                    self._generation += 1
+                    old = [pid for pid, generation in self._children.items() if generation != self._generation]
+                    for _ in range(self.workers):
+                        self._spawn(sock)
+                    self._kill(old, signal.SIGTERM)
+                    continue
+                current = sum(1 for generation in self._children.itervalues() if generation == self._generation)
+                for _ in range(self.workers - current):
+                    self._spawn(sock)
+                time.sleep(1.0)
+        finally:
+            self.stop()
+            sock.close()
+
+
+_REJECTED_RESPONSE = ('HTTP/1.1 503 %s\r\nContent-Type: text/plain\r\nContent-Length: 0\r\n'
+                      'Retry-After: 1\r\nConnection: close\r\n\r\n') % RESPONSE_STATUSES[503]
+
+
+class ThreadPoolServer(_BaseServer):
+    """
+    Accept connections on one thread and serve them by a fixed pool of threads.
+    The accepted connections wait in a queue of queue_size, a connection is
+    answered by 503 at once when the queue is full, and a kept-alive connection
+    is given up when others are waiting. The seconds spent by connections in
+    the queue and by requests in the application are recorded in info, the
+    queue time is recorded once per connection, so the later requests of a
+    kept-alive connection are not counted in it.
+    SIGTERM stops the server after the queued connections are served.
+    """
+    multithread = True
+    reject_linger_time = 0.1
+
+    def __init__(self, app, host='127.0.0.1', port=9000, threads=8, queue_size=64,
+                 keepalive_timeout=2.0, backlog=1024, timeout=30):
+        super(ThreadPoolServer, self).__init__(app, host, port, keepalive_timeout, backlog, timeout)
+        self.threads = threads
+        self._queue = Queue(queue_size)
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._rejected = 0
+        self._queue_time = 0.0
+        self._max_queue_time = 0.0
+        self._handler_time = 0.0
+        self._max_handler_time = 0.0
+        self._lingering = {}
+
+    @property
+    def info(self):
+        """
+        the statistics of the server, the times are in seconds. connections
+        and queue_time count the connections taken from the queue, requests
+        and handler_time count the requests served on them.
+        """
+        with self._lock:
+            return Dict(connections=self._connections, rejected=self._rejected, queued=self._queue.qsize(),
+                        queue_time=self._queue_time, max_queue_time=self._max_queue_time,
+                        requests=self.requests, handler_time=self._handler_time,
+                        max_handler_time=self._max_handler_time)
+
+    def request_started(self):
+        pass
+
+    def request_done(self, elapsed):
+        with self._lock:
+            self.requests += 1
+            self._handler_time += elapsed
+            if elapsed > self._max_handler_time:
+                self._max_handler_time = elapsed
+        return self.alive
+
+    def wait_request(self, conn):
+        """
+        the kept-alive connection is given up when other connections are
+        waiting in the queue.
+        """
+        deadline = time.time() + self.keepalive_timeout
+        while self.alive:
+            busy = not self._queue.empty()
+            timeout = 0 if busy else min(deadline - time.time(), 0.5)
+            if timeout < 0:
+                return False
+            if _select([conn], timeout):
+                return True
+            if busy:
+                return False
+        return False
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            conn, address, accepted_at = item
+            waited = time.time() - accepted_at
+            with self._lock:
+                self._connections += 1
+                self._queue_time += waited
+                if waited > self._max_queue_time:
+                    self._max_queue_time = waited
+            self._handle(conn, address)
+
+    def _reject(self, conn):
+        """
+        answer 503 without blocking, the connection lingers for at most
+        reject_linger_time seconds while the accepting thread reads the
+        request, since closing a socket with unread data resets the
+        connection and the client may lose the response.
+        """
+        with self._lock:
+            self._rejected += 1
+        try:
+            conn.setblocking(0)
+            conn.send(_REJECTED_RESPONSE)
+            conn.shutdown(socket.SHUT_WR)
+        except socket.error:
+            conn.close()
+            return
+        self._lingering[conn] = [time.time() + self.reject_linger_time, 0]
+
+    def _linger(self, readable):
+        """
+        read the readable lingering connections, and close the ones which
+        are finished, expired or have sent too much.
+        """
+        now = time.time()
+        for conn, item in self._lingering.items():
+            if conn in readable:
+                try:
+                    data = conn.recv(8192)
+                except socket.error as e:
+                    data = None if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK) else ''
+                if data is not None:
+                    item[1] += len(data)
+                    if not data or item[1] >= 65536:
+                        item[0] = now
+            if item[0] <= now:
+                del self._lingering[conn]
+                conn.close()
+
+    def stop(self):
+        """
+        stop accepting connections, the queued ones are still served.
+        """
+        self.alive = False
+
+    def serve_forever(self, sock=None):
+        """
+        accept connections until the server stops.
+        :param sock: the listening socket, which is bound if not given
+        """
+        if sock is None:
+            sock = self.bind()
+        self.socket = sock
+        try:
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        except ValueError:
+            pass
+        threads = []
+        for _ in range(self.threads):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        logging.info('serving on %s:%s with %d threads' % (self.host, self.server_port, self.threads))
+        try:
+            while self.alive:
+                timeout = 1.0
+                if self._lingering:
+                    deadline = min(item[0] for item in self._lingering.itervalues())
+                    timeout = max(min(deadline - time.time(), timeout), 0)
+                readable = _select([sock] + self._lingering.keys(), timeout)
+                if self._lingering:
+                    self._linger(readable)
+                if sock not in readable:
+                    continue
+                accepted = self._accept(sock)
+                if accepted is None:
+                    continue
+                conn, address = accepted
+                try:
+                    self._queue.put_nowait((conn, address, time.time()))
+                except Full:
+                    self._reject(conn)
+        finally:
+            self.alive = False
+            for conn in self._lingering:
+                conn.close()
+            self._lingering.clear()
+            for _ in threads:
+                self._queue.put(None)
+            for t in threads:
+                t.join()
+            sock.close()
@@ -0,0 +1,374 @@
+# -*- coding:utf-8 -*-
+"""
+    tindo.session
+    The stores which keep the session of each session id.
+"""
+import os
+import time
+import json
+import sqlite3
+import threading
+import zlib
+import hmac
+import base64
+import hashlib
+import logging
+from collections import OrderedDict
+from utils import Dict
+
+
+class Session(Dict):
+    """
+    A session Dict which records whether it has been modified. Changes made
+    inside mutable values are not seen, set session.modified = True for them.
+    """
+    def __init__(self, names=(), values=(), **kw):
+        super(Session, self).__init__(names, values, **kw)
+        self.__dict__['modified'] = False
+
+    def __setattr__(self, key, value):
+        if key == 'modified':
+            self.__dict__['modified'] = value
+        else:
+            self[key] = value
+
+    def __setitem__(self, key, value):
+        self.__dict__['modified'] = True
+        super(Session, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.__dict__['modified'] = True
+        super(Session, self).__delitem__(key)
+
+    def clear(self):
+        self.__dict__['modified'] = True
+        super(Session, self).clear()
+
+    def pop(self, key, *args):
+        self.__dict__['modified'] = True
+        return super(Session, self).pop(key, *args)
+
+    def popitem(self):
+        self.__dict__['modified'] = True
+        return super(Session, self).popitem()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.__dict__['modified'] = True
+        return super(Session, self).setdefault(key, default)
+
+    def update(self, *args, **kw):
+        self.__dict__['modified'] = True
+        super(Session, self).update(*args, **kw)
+
+
+class SessionStore(object):
+    """
+    The interface of session store, a session is a Session. A stateless
+    store keeps the whole session in the cookie instead of a session id.
+    """
+    stateless = False
+
+    def load(self, session_id):
+        """
+        Get the session of session_id, an empty one is created if not exist.
+        """
+        raise NotImplementedError
+
+    def get(self, session_id):
+        """
+        Get the session of session_id without creating it, None if not exist.
+        """
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        """
+        Drop the session of session_id.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Called at the end of every request.
+        """
+        pass
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Keep sessions in the runtime memory. The sessions are split into shards
+    by the hash of session id, and each shard has its own lock.
+    A session expires after ttl seconds without being loaded, the expired
+    sessions are swept at most once every sweep_interval seconds.
+    At most max_sessions are kept, which are divided among the shards, and
+    the least recently used one of a full shard is dropped. Pass None for
+    ttl and max_sessions to keep sessions forever.
+    """
+    def __init__(self, shards=16, ttl=86400, max_sessions=100000, sweep_interval=60):
+        if max_sessions is not None:
+            shards = max(min(shards, max_sessions), 1)
+        self._shards = [(threading.Lock(), OrderedDict()) for _ in range(shards)]
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        if max_sessions is None:
+            self._shard_max = None
+        else:
+            quotient, remainder = divmod(max_sessions, shards)
+            self._shard_max = [quotient + (1 if i < remainder else 0) for i in range(shards)]
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.time() + sweep_interval
+
+    def _shard(self, session_id):
+        return self._shards[hash(session_id) % len(self._shards)]
+
+    def load(self, session_id):
+        index = hash(session_id) % len(self._shards)
+        lock, sessions = self._shards[index]
+        now = time.time()
+        with lock:
+            item = sessions.pop(session_id, None)
+            if item is None or (self.ttl is not None and now - item[0] > self.ttl):
+                session = Session()
+            else:
+                session = item[1]
+            sessions[session_id] = (now, session)
+            if self._shard_max is not None and len(sessions) > self._shard_max[index]:
+                sessions.popitem(last=False)
+        if self.ttl is not None and now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            self.sweep(now)
+        return session
+
+    def get(self, session_id):
+        lock, sessions = self._shard(session_id)
+        now = time.time()
+        with lock:
+            item = sessions.pop(session_id, None)
+            if item is None or (self.ttl is not None and now - item[0] > self.ttl):
+                return None
+            sessions[session_id] = (now, item[1])
+        return item[1]
+
+    def delete(self, session_id):
+        lock, sessions = self._shard(session_id)
+        with lock:
+            sessions.pop(session_id, None)
+
+    def sweep(self, now=None):
+        """
+        Drop the expired sessions.
+        :return: the number of dropped sessions
+        """
+        if self.ttl is None:
+            return 0
+        deadline = (time.time() if now is None else now) - self.ttl
+        count = 0
+        for lock, sessions in self._shards:
+            with lock:
+                while sessions:
+                    session_id, item = next(sessions.iteritems())
+                    if item[0] >= deadline:
+                        break
+                    del sessions[session_id]
+                    count += 1
+        return count
+
+    def __len__(self):
+        return sum(len(sessions) for _, sessions in self._shards)
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class SignedCookieSessionStore(SessionStore):
+    """
+    Keep the whole session in a cookie signed by HMAC-SHA256, so no state
+    is kept on the server. The session is serialized as JSON, compressed
+    when it makes the cookie shorter, and the cookie is only sent again
+    when the session was modified.
+    A cookie older than max_age seconds is rejected.
+    """
+    stateless = True
+
+    def __init__(self, secret, cookie_name='session', max_age=None, domain=None,
+                 secure=False, compress=True):
+        self._secret = secret.encode('utf-8') if isinstance(secret, unicode) else secret
+        self.cookie_name = cookie_name
+        self.max_age = max_age
+        self.domain = domain
+        self.secure = secure
+        self.compress = compress
+
+    def _sign(self, value):
+        return _b64encode(hmac.new(self._secret, value, hashlib.sha256).digest())
+
+    def dumps(self, session):
+        """
+        serialize the session as signed cookie value
+        :param session: the session
+        :return: str
+        """
+        payload = json.dumps(dict(session), separators=(',', ':'))
+        if self.compress:
+            compressed = zlib.compress(payload)
+            if len(compressed) < len(payload):
+                payload = '.' + _b64encode(compressed)
+            else:
+                payload = _b64encode(payload)
+        else:
+            payload = _b64encode(payload)
+        value = '%s.%x' % (payload, int(time.time()))
+        value = '%s.%s' % (value, self._sign(value))
+        if len(value) > 4000:
+            logging.warning('The session cookie is %d bytes, which may be dropped by browsers.' % len(value))
+        return value
+
+    def loads(self, value):
+        """
+        verify and decode the signed cookie value
+        :param value: the cookie value
+        :return: a Session, None if the value is invalid or expired
+        """
+        try:
+            value = str(value)
+            signed, signature = value.rsplit('.', 1)
+            if not hmac.compare_digest(self._sign(signed), signature):
+                return None
+            payload, timestamp = signed.rsplit('.', 1)
+            if self.max_age is not None and time.time() - int(timestamp, 16) > self.max_age:
+                return None
+            if payload.startswith('.'):
+                payload = zlib.decompress(_b64decode(payload[1:]))
+            else:
+                payload = _b64decode(payload)
+            data = json.loads(payload)
+            return Session(data.keys(), data.values())
+        except (ValueError, TypeError, AttributeError, zlib.error, UnicodeError):
+            return None
+
+    def load(self, session_id):
+        raise NotImplementedError('The session is kept in cookie by SignedCookieSessionStore')
+
+    get = load
+
+    def delete(self, session_id):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Keep sessions in a local SQLite database in WAL mode, so the worker
+    processes on one host share sessions. The sessions loaded by a request
+    are cached until flush() at the end of it, when the modified ones are
+    written in one transaction.
+    A session expires after ttl seconds without being modified, the expires
+    column is indexed and the expired rows are swept at most once every
+    sweep_interval seconds. The sessions are stored as JSON, so the values
+    must be JSON serializable, as in SignedCookieSessionStore.
+    """
+    def __init__(self, path, ttl=None, timeout=5.0, sweep_interval=60):
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.time() + sweep_interval
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)')
+
+    def _connect(self):
+        """
+        get the connection of current thread, which is re-opened after fork.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _loaded(self):
+        loaded = getattr(self._local, 'loaded', None)
+        if loaded is None:
+            loaded = self._local.loaded = {}
+        return loaded
+
+    def _get_item(self, session_id):
+        loaded = self._loaded()
+        item = loaded.get(session_id)
+        if item is None:
+            row = self._connect().execute('SELECT data, expires FROM sessions WHERE id = ?',
+                                          (session_id,)).fetchone()
+            data = None
+            if row is not None and (row[1] is None or row[1] >= time.time()):
+                try:
+                    data = json.loads(row[0])
+                except (ValueError, TypeError):
+                    logging.warning('The session %s is not valid JSON, which is dropped.' % session_id)
+            if isinstance(data, dict):
+                item = loaded[session_id] = (Session(data.keys(), data.values()), row[1])
+        return item
+
+    def load(self, session_id):
+        item = self._get_item(session_id)
+        if item is None:
+            item = self._loaded()[session_id] = (Session(), None)
+        return item[0]
+
+    def get(self, session_id):
+        item = self._get_item(session_id)
+        return None if item is None else item[0]
+
+    def delete(self, session_id):
+        self._loaded().pop(session_id, None)
+        self._connect().execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+
+    def flush(self):
+        loaded = getattr(self._local, 'loaded', None)
+        if not loaded:
+            return
+        self._local.loaded = {}
+        now = time.time()
+        expires = None if self.ttl is None else now + self.ttl
+        saved = []
+        touched = []
+        for session_id, (session, old_expires) in loaded.iteritems():
+            if session.modified:
+                saved.append((session_id, json.dumps(dict(session), separators=(',', ':')), expires))
+            elif old_expires is not None and expires is not None and old_expires - now < self.ttl / 2.0:
+                touched.append((expires, session_id))
+        if not saved and not touched:
+            return
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if saved:
+                conn.executemany('INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)', saved)
+            if touched:
+                conn.executemany('UPDATE sessions SET expires = ? WHERE id = ?', touched)
+            if self.ttl is not None and now >= self._next_sweep:
+                self._next_sweep = now + self.sweep_interval
+                conn.execute('DELETE FROM sessions WHERE expires < ?', (now,))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def __len__(self):
+        row = self._connect().execute('SELECT COUNT(*) FROM sessions WHERE expires IS NULL OR expires >= ?',
+                                      (time.time(),)).fetchone()
+        return row[0]
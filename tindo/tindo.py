@@ -8,6 +8,7 @@
     :license: MIT, see license for more details
 """
 import os
+import stat
 import mimetypes
 import cgi
 import warnings
@@ -15,27 +16,52 @@ import types
 import StringIO
 import traceback
 import sys
-from threading import Lock
+import time
 import re
+import json
+import zlib
 import datetime
 import functools
 import logging
-from uuid import uuid1
+import hashlib
+from uuid import uuid1, uuid4
 from http import RESPONSE_STATUSES, RESPONSE_HEADER_DICT, HEADER_X_POWERED_BY, RE_RESPONSE_STATUS
 from http import RedirectError, bad_request, not_found, HttpError
-from http import to_str, to_unicode, quote, unquote
-from utils import Dict, UTC
-from local import Local
+from http import to_str, to_unicode, quote, unquote, http_date, parse_http_date, parse_range_header
+from http import accepts_encoding, parse_qs
+from utils import Dict, UTC, LRUCache
+from local import Local, release_local, set_ident_func, greenlet_ident
+from session import Session, MemorySessionStore
+from multipart import parse_multipart, MultipartPart, MultipartError
+from server import PreforkServer, ThreadPoolServer
+from metrics import Metrics
 
 
 ctx = Local()
 
 
-def route(path, methods=None):
+def _json_codec():
+    """
+    use ujson if it is installed, otherwise the json module.
+    :return: a tuple of (dumps, loads)
+    """
+    try:
+        import ujson
+        return ujson.dumps, ujson.loads
+    except ImportError:
+        return functools.partial(json.dumps, separators=(',', ':')), json.loads
+
+
+_json_dumps, _json_loads = _json_codec()
+
+
+def route(path, methods=None, blocking=False):
     """
     route decorator
     :param path: the url path
     :param methods: HTTP's Methods, defaults is 'GET'
+    :param blocking: whether the function blocks without yielding to other
+                     greenlets, which is run in the thread pool by serve_gevent()
     :return:
     """
     if methods is None:
@@ -47,6 +73,7 @@ def route(path, methods=None):
             return func(*args, **kw)
         wrapper.__web_route__ = path
         wrapper.__web_method__ = methods
+        wrapper.__web_blocking__ = blocking
         return wrapper
     return _decorator
 
@@ -127,6 +154,7 @@ class Route(object):
     def __init__(self, func):
         self.path = func.__web_route__
         self.methods = func.__web_method__
+        self.blocking = getattr(func, '__web_blocking__', False)
         self.route = re.compile(_build_regex(self.path))
         self.func = func
 
@@ -145,20 +173,244 @@ class Route(object):
     __repr__ = __str__
 
 
-def _static_file_generator(file_path):
-    block_size = 8192
-    with open(file_path, 'rb') as f:
-        block = f.read(block_size)
+_re_param_segment = re.compile(r'^<([a-zA-Z_]\w*)>$')
+
+
+class _RouteNode(object):
+    """
+    A node of the route tree, each node stands for one path segment.
+    """
+    __slots__ = ('static', 'params', 'route')
+
+    def __init__(self):
+        self.static = {}
+        self.params = []
+        self.route = None
+
+
+class Router(object):
+    """
+    A segment-based radix tree of routes.
+    Static segments are resolved by dict lookup, a '<name>' segment captures
+    the whole segment and a mixed segment such as '<name>.html' falls back to
+    a regex of that segment only. So the lookup cost depends on the depth of
+    the path rather than the number of routes.
+    """
+
+    def __init__(self):
+        self._root = _RouteNode()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, route):
+        """
+        add a Route object as a leaf of the tree.
+        if the path has been added, the first one wins.
+        :param route: the Route object
+        :return:
+        """
+        node = self._root
+        for segment in route.path.split('/'):
+            if not _re_route.search(segment):
+                child = node.static.get(segment)
+                if child is None:
+                    child = node.static[segment] = _RouteNode()
+            else:
+                key = None if _re_param_segment.match(segment) else _build_regex(segment)
+                for k, _, n in node.params:
+                    if k == key:
+                        child = n
+                        break
+                else:
+                    child = _RouteNode()
+                    node.params.append((key, re.compile(key) if key else None, child))
+            node = child
+        if node.route is None:
+            node.route = route
+            self._size += 1
+
+    def match(self, url):
+        """
+        find the route of url
+        :param url: the url path
+        :return: a tuple of (Route, args) or None
+        """
+        return self._match(self._root, url.split('/'), 0, [])
+
+    def _match(self, node, segments, i, args):
+        if i == len(segments):
+            if node.route is not None:
+                return node.route, tuple(args)
+            return None
+        segment = segments[i]
+        child = node.static.get(segment)
+        if child is not None:
+            r = self._match(child, segments, i + 1, args)
+            if r is not None:
+                return r
+        if segment:
+            n = len(args)
+            for _, regex, child in node.params:
+                if regex is None:
+                    args.append(segment)
+                else:
+                    m = regex.match(segment)
+                    if m is None:
+                        continue
+                    args.extend(m.groups())
+                r = self._match(child, segments, i + 1, args)
+                if r is not None:
+                    return r
+                del args[n:]
+        return None
+
+
+def _static_file_generator(fp, block_size=8192):
+    try:
+        block = fp.read(block_size)
         while block:
             yield block
-            block = f.read(block_size)
+            block = fp.read(block_size)
+    finally:
+        fp.close()
+
+
+_COMPRESSIBLE_TYPES = frozenset(['application/javascript', 'application/x-javascript', 'application/json',
+                                 'application/xml', 'application/xhtml+xml', 'image/svg+xml'])
+
+
+def _is_compressible(content_type):
+    if not content_type:
+        return False
+    content_type = content_type.partition(';')[0].strip().lower()
+    return content_type.startswith('text/') or content_type in _COMPRESSIBLE_TYPES
+
+
+def _gzip(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _accepts_gzip():
+    return accepts_encoding(ctx.request.header('ACCEPT-ENCODING'), 'gzip')
+
+
+def _add_vary(response, name='Accept-Encoding'):
+    vary = response.header('VARY')
+    if not vary:
+        response.set_header('VARY', name)
+    elif name.lower() not in vary.lower():
+        response.set_header('VARY', '%s, %s' % (vary, name))
+
+
+_JOIN_SIZE = 65536
+
+
+def _normalize_body(body, response):
+    """
+    make the body an efficient iterable for WSGI server: a str is yielded once,
+    a list of str chunks up to _JOIN_SIZE bytes is joined into one, and other
+    iterables such as generator are streamed untouched.
+    Content-Length is set for the in-memory body if it is not set.
+    """
+    if isinstance(body, str):
+        length = len(body)
+        body = [body]
+    elif isinstance(body, (list, tuple)):
+        length = 0
+        for chunk in body:
+            if not isinstance(chunk, str):
+                return body
+            length += len(chunk)
+        if len(body) > 1 and length <= _JOIN_SIZE:
+            body = [''.join(body)]
+    else:
+        return body
+    if response.header('CONTENT-LENGTH') is None and response.status_code not in (204, 304):
+        response.content_length = length
+    return body
+
+
+def _error_page(status):
+    return '<html><body><h1>%s</h1></body></html>' % status
+
+
+def _static_range_generator(fp, parts, tail='', block_size=8192):
+    """
+    stream slices of file
+    :param fp: the file object
+    :param parts: a list of (head, start, stop), head is yielded before the slice
+    :param tail: yielded after all slices
+    :param block_size: the read size
+    :return:
+    """
+    try:
+        for head, start, stop in parts:
+            if head:
+                yield head
+            fp.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                block = fp.read(min(block_size, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+        if tail:
+            yield tail
+    finally:
+        fp.close()
+
+
+class _CachedStaticFile(object):
+    """
+    A static file kept in memory.
+    """
+    __slots__ = ('body', 'content_type', 'etag', 'last_modified', 'mtime', 'size', 'checked')
+
+    def __init__(self, body, content_type, etag, last_modified, st):
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        self.checked = time.time()
 
 
 class StaticFileRoute(object):
-    def __int__(self):
-        self.method = ['GET']
+    """
+    Serve the files under document_root/static, a path which leaves it by
+    '..' is answered by 404. The file is handed to the server's
+    wsgi.file_wrapper when it provides one, which may use sendfile,
+    otherwise it is read in blocks of block_size.
+    ETag and Last-Modified are computed from the mtime and size of the file,
+    a conditional request whose validators match is answered by 304.
+    Range requests are answered by 206 with the requested slices only.
+    If cache_size is given, files up to cache_max_file_size are kept in memory
+    within cache_size bytes, and their mtime is re-checked every check_interval
+    seconds.
+    If gzip_level is given, a 'file.css.gz' sibling is served to clients accepting
+    gzip, otherwise compressible files from gzip_min_size up to cache_max_file_size
+    are gzipped, and the compressed bodies are kept within gzip_cache_size bytes.
+    """
+    def __init__(self, block_size=65536, max_age=None, cache_size=0,
+                 check_interval=1.0, cache_max_file_size=262144,
+                 gzip_level=None, gzip_min_size=1024, gzip_cache_size=4194304):
+        self.methods = ['GET']
+        self.path = '/static/<path>'
         self.is_static = True
-        self.route = re.compile('^/static/(.+)$')
+        self.block_size = block_size
+        self.cache_control = None if max_age is None else 'public, max-age=%d' % max_age
+        self.cache = LRUCache(cache_size, sizeof=lambda entry: entry.size) if cache_size > 0 else None
+        self.check_interval = check_interval
+        self.cache_max_file_size = cache_max_file_size
+        self.gzip_level = gzip_level
+        self.gzip_min_size = gzip_min_size
+        self.gzip_cache = LRUCache(gzip_cache_size, sizeof=len) if gzip_level is not None else None
+        self._validators = {}
 
     @staticmethod
     def match(url):
@@ -166,17 +418,198 @@ class StaticFileRoute(object):
             return url[1:],
         return None
 
+    def _get_validators(self, file_path, st):
+        """
+        get the (etag, last_modified) of file, which are cached per path.
+        """
+        v = self._validators.get(file_path)
+        if v is None or v[0] != st.st_mtime or v[1] != st.st_size:
+            v = (st.st_mtime, st.st_size, '"%x-%x"' % (int(st.st_mtime), st.st_size), http_date(st.st_mtime))
+            self._validators[file_path] = v
+        return v[2], v[3]
+
+    @staticmethod
+    def _not_modified(etag, mtime):
+        if_none_match = ctx.request.header('IF-NONE-MATCH')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return True
+            for tag in if_none_match.split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'):
+                    tag = tag[2:]
+                if tag == etag:
+                    return True
+            return False
+        if_modified_since = ctx.request.header('IF-MODIFIED-SINCE')
+        if if_modified_since is not None:
+            t = parse_http_date(if_modified_since)
+            return t is not None and int(mtime) <= t
+        return False
+
+    @staticmethod
+    def _get_ranges(etag, last_modified, size):
+        range_header = ctx.request.header('RANGE')
+        if range_header is None:
+            return None
+        if_range = ctx.request.header('IF-RANGE')
+        if if_range is not None and if_range.strip() not in (etag, last_modified):
+            return None
+        return parse_range_header(range_header, size)
+
+    def _partial_content(self, fp, ranges, content_type, size):
+        response = ctx.response
+        response.status = 206
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            response.content_type = content_type
+            response.content_length = stop - start
+            response.set_header('CONTENT-RANGE', 'bytes %d-%d/%d' % (start, stop - 1, size))
+            return _static_range_generator(fp, [('', start, stop)], block_size=self.block_size)
+        boundary = uuid4().hex
+        parts = []
+        length = 0
+        for start, stop in ranges:
+            head = '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+                boundary, content_type, start, stop - 1, size)
+            parts.append((head, start, stop))
+            length += len(head) + stop - start
+        tail = '\r\n--%s--\r\n' % boundary
+        response.content_type = 'multipart/byteranges; boundary=%s' % boundary
+        response.content_length = length + len(tail)
+        return _static_range_generator(fp, parts, tail, self.block_size)
+
+    def _get_cached(self, file_path):
+        """
+        get the cached file, the mtime is re-checked once check_interval elapsed.
+        """
+        entry = self.cache.get(file_path)
+        if entry is None:
+            return None
+        now = time.time()
+        if now - entry.checked > self.check_interval:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                self.cache.pop(file_path)
+                return None
+            if st.st_mtime != entry.mtime or st.st_size != entry.size:
+                self.cache.pop(file_path)
+                return None
+            entry.checked = now
+        return entry
+
+    @staticmethod
+    def _open(file_path):
+        """
+        open the regular file
+        :return: a tuple of (fp, stat), (None, None) if it does not exist
+        """
+        try:
+            fp = open(file_path, 'rb')
+        except IOError:
+            return None, None
+        st = os.fstat(fp.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            fp.close()
+            return None, None
+        return fp, st
+
     def __call__(self, *args, **kwargs):
-        file_path = os.path.join(ctx.application.document_root, args[0])
-        if not os.path.isfile(file_path):
+        document_root = os.path.normpath(ctx.application.document_root)
+        file_path = os.path.normpath(os.path.join(document_root, args[0]))
+        if not file_path.startswith(os.path.join(document_root, 'static', '')) or '\0' in file_path:
             raise not_found()
-        file_extension = os.path.splitext(file_path)[1]
-        ctx.response.content_type = mimetypes.types_map.get(file_extension.lower(), 'application/octet-stream')
-        return _static_file_generator(file_path)
+        entry = self._get_cached(file_path) if self.cache is not None else None
+        if entry is not None:
+            content_type = entry.content_type
+        else:
+            file_extension = os.path.splitext(file_path)[1]
+            content_type = mimetypes.types_map.get(file_extension.lower(), 'application/octet-stream')
+        gzip = False
+        if self.gzip_level is not None and _is_compressible(content_type):
+            _add_vary(ctx.response)
+            gzip = _accepts_gzip()
+            if gzip:
+                fp, st = self._open(file_path + '.gz')
+                if fp is not None:
+                    ctx.response.set_header('CONTENT-ENCODING', 'gzip')
+                    etag, last_modified = self._get_validators(file_path + '.gz', st)
+                    return self._respond(fp, None, content_type, etag, last_modified, st.st_mtime, st.st_size)
+        body = None
+        if entry is not None:
+            fp = None
+            body, etag, last_modified, mtime, size = (entry.body, entry.etag, entry.last_modified,
+                                                      entry.mtime, entry.size)
+        else:
+            fp, st = self._open(file_path)
+            if fp is None:
+                raise not_found()
+            etag, last_modified = self._get_validators(file_path, st)
+            mtime, size = st.st_mtime, st.st_size
+            if self.cache is not None and size <= self.cache_max_file_size:
+                try:
+                    body = fp.read()
+                finally:
+                    fp.close()
+                fp = None
+                self.cache.set(file_path, _CachedStaticFile(body, content_type, etag, last_modified, st))
+        if gzip and self.gzip_min_size <= size <= self.cache_max_file_size:
+            if body is None:
+                try:
+                    body = fp.read()
+                finally:
+                    fp.close()
+                fp = None
+            key = (file_path, mtime, size)
+            compressed = self.gzip_cache.get(key)
+            if compressed is None:
+                compressed = _gzip(body, self.gzip_level)
+                self.gzip_cache.set(key, compressed)
+            ctx.response.set_header('CONTENT-ENCODING', 'gzip')
+            return self._respond(None, compressed, content_type, etag[:-1] + '-gzip"', last_modified,
+                                 mtime, len(compressed))
+        return self._respond(fp, body, content_type, etag, last_modified, mtime, size)
+
+    def _respond(self, fp, body, content_type, etag, last_modified, mtime, size):
+        """
+        make response of the file, whose content is either the opened fp or the cached body.
+        """
+        response = ctx.response
+        response.set_header('ACCEPT-RANGES', 'bytes')
+        response.set_header('ETAG', etag)
+        response.set_header('LAST-MODIFIED', last_modified)
+        if self.cache_control is not None:
+            response.set_header('CACHE-CONTROL', self.cache_control)
+        if self._not_modified(etag, mtime):
+            if fp is not None:
+                fp.close()
+            response.status = 304
+            response.content_type = None
+            return []
+        ranges = self._get_ranges(etag, last_modified, size)
+        if ranges is not None:
+            if not ranges:
+                if fp is not None:
+                    fp.close()
+                response.unset_header('CONTENT-ENCODING')
+                response.set_header('CONTENT-RANGE', 'bytes */%d' % size)
+                raise HttpError(416)
+            if fp is None:
+                fp = StringIO.StringIO(body)
+            return self._partial_content(fp, ranges, content_type, size)
+        response.content_type = content_type
+        response.content_length = size
+        if body is not None:
+            return [body]
+        file_wrapper = ctx.request.environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(fp, self.block_size)
+        return _static_file_generator(fp, self.block_size)
 
 
 def favicon_handler():
-    return _static_file_generator('/favicon.ico')
+    return _static_file_generator(open('/favicon.ico', 'rb'))
 
 
 class MultipartFile(object):
@@ -187,49 +620,171 @@ class MultipartFile(object):
         self.file = storage.file
 
 
-_SESSIONS_WAREHOUSE = {}
+_default_session_store = MemorySessionStore()
+
 
-_session_lock = Lock()
+def _get_session_store():
+    application = getattr(ctx, 'application', None)
+    return _default_session_store if application is None else application.session_store
 
 
 def _get_session(session_id):
     """
-    get session from the runtime memory, which store as dictionary.
-    Using lock to make thread-safe.
+    get session from the session store of application, which is a
+    MemorySessionStore by default.
     :param session_id: the session id assigned to each request.
-    :return: a Dict
+    :return: a Session
     """
-    with _session_lock:
-        if session_id not in _SESSIONS_WAREHOUSE:
-            _SESSIONS_WAREHOUSE[session_id] = Dict()
-        return _SESSIONS_WAREHOUSE[session_id]
+    return _get_session_store().load(session_id)
 
 
 class Request(object):
     """Request object for obtaining all http request information.
     """
-    def __init__(self, environ):
+    def __init__(self, environ, max_body_size=None, max_part_size=None, max_form_fields=None,
+                 spool_threshold=1048576, max_json_size=None, max_field_size=1048576):
         self._environ = environ
-
-    def _parse_input(self):
-        def _convert(item):
-            if isinstance(item, list):
-                return [to_unicode(i.value) for i in item]
-            if item.filename:
-                return MultipartFile(item)
-            return to_unicode(item.value)
-        fs = cgi.FieldStorage(fp=self._environ['wsgi.input'], environ=self._environ, keep_blank_values=True)
+        self._consumed = False
+        self.max_json_size = max_json_size
+        self.max_body_size = max_body_size
+        self.max_part_size = max_part_size
+        self.max_form_fields = max_form_fields
+        self.max_field_size = max_field_size
+        self.spool_threshold = spool_threshold
+
+    def _read_chunks(self, chunk_size, max_size):
+        """
+        read wsgi.input in chunks up to CONTENT_LENGTH, raise 413 if it is
+        larger than max_size. Without CONTENT_LENGTH the body is empty, unless
+        the server sets wsgi.input_terminated and the input is read to its end.
+        """
+        try:
+            length = int(self._environ.get('CONTENT_LENGTH') or -1)
+        except ValueError:
+            length = -1
+        if length < 0 and not self._environ.get('wsgi.input_terminated'):
+            length = 0
+        if length >= 0 and max_size is not None and length > max_size:
+            raise HttpError(413)
+        fp = self._environ['wsgi.input']
+        read = 0
+        while length < 0 or read < length:
+            chunk = fp.read(chunk_size if length < 0 else min(chunk_size, length - read))
+            if not chunk:
+                break
+            read += len(chunk)
+            if max_size is not None and read > max_size:
+                raise HttpError(413)
+            yield chunk
+
+    def _read_body(self, max_size):
+        if not hasattr(self, '_body'):
+            if self._consumed:
+                raise RuntimeError('The request body has been consumed by stream()')
+            self._consumed = True
+            self._body = ''.join(self._read_chunks(65536, max_size))
+        elif max_size is not None and len(self._body) > max_size:
+            raise HttpError(413)
+        return self._body
+
+    def stream(self, chunk_size=65536):
+        """Get an iterator of the body chunks for processing upload incrementally. The body
+        is read up to CONTENT_LENGTH, and 413 is raised if it is larger than max_body_size.
+        The body can be streamed only once unless it has been read by get_body().
+        """
+        if hasattr(self, '_body'):
+            body = self._body
+            return (body[i:i + chunk_size] for i in xrange(0, len(body), chunk_size))
+        if self._consumed:
+            raise RuntimeError('The request body has been consumed by stream()')
+        self._consumed = True
+        return self._read_chunks(chunk_size, self.max_body_size)
+
+    def _parse_multipart(self, boundary):
+        try:
+            fields = parse_multipart(self.stream(), boundary, spool_threshold=self.spool_threshold,
+                                     max_part_size=self.max_part_size, max_fields=self.max_form_fields,
+                                     max_field_size=self.max_field_size)
+        except MultipartError, e:
+            logging.info('Bad multipart body: %s' % e)
+            bad_request()
         inputs = dict()
-        for key in fs:
-            inputs[key] = _convert(fs[key])
+        for key, value in fields:
+            if isinstance(value, MultipartPart):
+                value = MultipartFile(value) if value.filename else to_unicode(value.file.read())
+            if key not in inputs:
+                inputs[key] = value
+            elif isinstance(inputs[key], list):
+                inputs[key].append(value)
+            else:
+                inputs[key] = [inputs[key], value]
+        return inputs
+
+    def _parse_qs(self, qs):
+        try:
+            inputs = parse_qs(qs)
+        except UnicodeError:
+            bad_request()
+        if self.max_form_fields is not None and len(inputs) > self.max_form_fields:
+            raise HttpError(413)
         return inputs
 
+    def _parse_form(self):
+        content_type, params = cgi.parse_header(self._environ.get('CONTENT_TYPE', ''))
+        if content_type == 'multipart/form-data':
+            boundary = params.get('boundary')
+            if not boundary:
+                bad_request()
+            return self._parse_multipart(boundary)
+        if content_type == 'application/x-www-form-urlencoded' or \
+                (not content_type and self._environ.get('REQUEST_METHOD') in ('POST', 'PUT', 'PATCH')):
+            return self._parse_qs(self.get_body())
+        return {}
+
+    def _get_args(self):
+        if not hasattr(self, '_args'):
+            self._args = self._parse_qs(self.query_string)
+        return self._args
+
+    def _get_form(self):
+        if not hasattr(self, '_form'):
+            self._form = self._parse_form()
+        return self._form
+
+    @property
+    def args(self):
+        """Get the parameters of query string as dict, the value is unicode or list of unicode.
+        The query string is parsed once and the body is never read.
+        """
+        return dict(self._get_args())
+
+    @property
+    def form(self):
+        """Get the parameters of body as dict, the value is unicode, MultipartFile or list of them.
+        """
+        return dict(self._get_form())
+
     def _get_raw_input(self):
-        """Get raw input as dict containing values as unicode, list or MultipartFile.
+        """Get raw input as dict containing values as unicode, list or MultipartFile,
+        which merges form and args.
         :return:
         """
         if not hasattr(self, '_raw_input'):
-            self._raw_input = self._parse_input()
+            args = self._get_args()
+            form = self._get_form()
+            if not form:
+                self._raw_input = args
+            elif not args:
+                self._raw_input = form
+            else:
+                inputs = dict(form)
+                for k, v in args.iteritems():
+                    if k not in inputs:
+                        inputs[k] = v
+                    else:
+                        first = inputs[k] if isinstance(inputs[k], list) else [inputs[k]]
+                        inputs[k] = first + (v if isinstance(v, list) else [v])
+                self._raw_input = inputs
         return self._raw_input
 
     def __getitem__(self, key):
@@ -276,11 +831,30 @@ class Request(object):
         return copy
 
     def get_body(self):
-        """Get raw data from HTTP POST and return as str.
+        """Get raw data from HTTP POST and return as str. The body is read up to CONTENT_LENGTH
+        once, and shared by form and JSON parsing. Raise 413 if it is larger than max_body_size.
         :return:
         """
-        fp = self._environ['wsgi.input']
-        return fp.read()
+        return self._read_body(self.max_body_size)
+
+    @property
+    def json(self):
+        """Get the body parsed as JSON, which is parsed once. Return None if no body.
+        Raise 413 if the body is larger than max_json_size, or 400 if it is not JSON.
+        """
+        if not hasattr(self, '_json'):
+            max_size = self.max_json_size
+            if max_size is None or (self.max_body_size is not None and self.max_body_size < max_size):
+                max_size = self.max_body_size
+            body = self._read_body(max_size)
+            if not body:
+                self._json = None
+            else:
+                try:
+                    self._json = _json_loads(body)
+                except ValueError:
+                    bad_request()
+        return self._json
 
     @property
     def remote_addr(self):
@@ -377,53 +951,61 @@ class Request(object):
 
     @property
     def session(self):
+        """
+        the session of the request, None if the client has none. It is never
+        created here, so unknown session ids do not fill the store, use
+        Response.session to create one.
+        """
+        store = _get_session_store()
+        if store.stateless:
+            if not hasattr(self, '_session'):
+                value = self.cookie(store.cookie_name)
+                self._session = None if value is None else store.loads(value)
+            return self._session
         sessionid = self.cookie('sessionid')
         if sessionid is not None:
-            return _get_session(sessionid)
+            return store.get(sessionid)
 
 
 UTC_0 = UTC('+00:00')
 
 
+_DEFAULT_CONTENT_TYPE = ('Content-Type', 'text/html; charset=utf-8')
+
+
 class Response(object):
     """
-    The Response from the web server
+    The Response from the web server, the headers are kept as
+    {'CONTENT-TYPE': ('Content-Type', value)} so they are in their final form.
     """
     def __init__(self):
         self._status = '200 OK'
-        self._headers = {'CONTENT-TYPE': 'text/html; charset=utf-8'}
+        self._headers = {'CONTENT-TYPE': _DEFAULT_CONTENT_TYPE}
 
     @property
     def headers(self):
-        _headers = [(RESPONSE_HEADER_DICT.get(k, k), v) for k, v in self._headers.iteritems()]
+        _headers = self._headers.values()
         if hasattr(self, '_cookies'):
-            for v in self._cookies.itervalues():
-                _headers.append(('Set-Cookie', v))
+            _headers.extend([('Set-Cookie', v) for v in self._cookies.itervalues()])
         _headers.append(HEADER_X_POWERED_BY)
         return _headers
 
     def header(self, name):
-        key = name.upper()
-        if key not in RESPONSE_HEADER_DICT:
-            key = name
-        return self._headers.get(key)
+        item = self._headers.get(name.upper())
+        if item is None:
+            return None
+        return item[1]
 
     def unset_header(self, name):
-        key = name.upper()
-        if key not in RESPONSE_HEADER_DICT:
-            key = name
-        if key in self._headers:
-            del self._headers[key]
+        self._headers.pop(name.upper(), None)
 
     def set_header(self, name, value):
         key = name.upper()
-        if key not in RESPONSE_HEADER_DICT:
-            key = name
-        self._headers[key] = to_str(value)
+        self._headers[key] = (RESPONSE_HEADER_DICT.get(key, name), to_str(value))
 
     @property
     def content_type(self):
-        return self._headers['CONTENT-TYPE']
+        return self._headers['CONTENT-TYPE'][1]
 
     @content_type.setter
     def content_type(self, value):
@@ -502,53 +1084,194 @@ class Response(object):
 
     @property
     def session(self):
-        if ctx.request.session is None:
-            sessionid = str(uuid1())
-            self.set_cookie('sessionid', sessionid)
-        else:
+        store = _get_session_store()
+        if store.stateless:
+            if not hasattr(self, '_session'):
+                session = ctx.request.session
+                self._session = Session() if session is None else session
+            return self._session
+        sessionid = getattr(self, '_session_id', None)
+        if sessionid is None:
             sessionid = ctx.request.cookie('sessionid')
+            if sessionid is None:
+                sessionid = str(uuid1())
+            self._session_id = sessionid
             self.set_cookie('sessionid', sessionid)
         return _get_session(sessionid)
 
 
 class Template(object):
+    """
+    A template to render with the model. If stream is True, the page is
+    rendered chunk by chunk while it is sent, each chunk has about
+    buffer_size characters. If cache_ttl is given, the rendered page is
+    cached for cache_ttl seconds, keyed by cache_key(model) or the hash
+    of model, which must be made of JSON primitives.
+    """
+    stream = False
+    buffer_size = 8192
+    cache_ttl = None
+    cache_key = None
+
     def __init__(self, template_name, **kw):
         self.template_name = template_name
         self.model = dict(**kw)
 
 
+class JSONResponse(object):
+    """
+    A response whose data is serialized as JSON, a returned dict is the same
+    as JSONResponse(dict).
+    """
+    def __init__(self, data, status=None):
+        self.data = data
+        self.status = status
+
+
 class TemplateEngine(object):
     def __call__(self, path, model):
         return '<!-- override this method to render template -->'
 
+    def generate(self, path, model, buffer_size=8192):
+        """
+        render template as an iterable of str chunks.
+        """
+        return [self(path, model)]
+
+    def precompile(self):
+        """
+        compile all templates ahead of the first request.
+        :return: the number of compiled templates
+        """
+        return 0
+
+
+def _buffered_generator(events, buffer_size):
+    buf = []
+    size = 0
+    for event in events:
+        buf.append(event)
+        size += len(event)
+        if size >= buffer_size:
+            yield u''.join(buf).encode('utf-8')
+            buf = []
+            size = 0
+    if buf:
+        yield u''.join(buf).encode('utf-8')
+
 
 class Jinja2TemplateEngine(TemplateEngine):
-    def __init__(self, templ_dir, **kw):
-        from jinja2 import Environment, FileSystemLoader
+    """
+    Render templates by jinja2. Without auto_reload the compiled templates
+    are kept in a dict and never checked against the files again. If
+    bytecode_cache_dir is given, the compiled bytecode is cached on disk
+    and shared by workers and restarts.
+    """
+    def __init__(self, templ_dir, cache_size=400, auto_reload=True, bytecode_cache_dir=None, **kw):
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
         if 'autoescape' not in kw:
             kw['autoescape'] = True
-        self._env = Environment(loader=FileSystemLoader(templ_dir), **kw)
+        if bytecode_cache_dir is not None:
+            kw['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache_dir)
+        self._env = Environment(loader=FileSystemLoader(templ_dir), cache_size=cache_size,
+                                auto_reload=auto_reload, **kw)
+        self._templates = None if auto_reload else {}
 
     def add_filter(self, name, fn_filter):
         self._env.filters[name] = fn_filter
 
+    def _get_template(self, path):
+        if self._templates is None:
+            return self._env.get_template(path)
+        template = self._templates.get(path)
+        if template is None:
+            template = self._templates[path] = self._env.get_template(path)
+        return template
+
+    def precompile(self, extensions=('html', 'htm', 'xml', 'txt')):
+        """
+        compile the templates under templ_dir, the filters must be added before.
+        A template which fails to compile is logged and skipped, it raises the
+        error again when it is rendered.
+        :param extensions: only compile the files with these extensions
+        :return: the number of compiled templates
+        """
+        from jinja2 import TemplateError
+        count = 0
+        for name in self._env.list_templates(extensions=extensions):
+            try:
+                self._get_template(name)
+            except (TemplateError, UnicodeError) as e:
+                logging.error('Failed to compile template %s: %s' % (name, e))
+            else:
+                count += 1
+        return count
+
     def __call__(self, path, model):
-        return self._env.get_template(path).render(**model).encode('utf-8')
+        return self._get_template(path).render(**model).encode('utf-8')
+
+    def generate(self, path, model, buffer_size=8192):
+        """
+        render template by jinja2's generate(), the template is loaded at once
+        and the page is rendered while the chunks are iterated.
+        """
+        return _buffered_generator(self._get_template(path).generate(**model), buffer_size)
 
 
-def view(path):
+def _is_plain(value):
+    """
+    whether value is made of JSON primitives only, so that it is fully
+    described by its JSON form.
+    """
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(_is_plain(v) for v in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, basestring) and _is_plain(v) for k, v in value.iteritems())
+    return False
+
+
+def _model_hash(model):
+    """
+    the hash of model, None if model holds other objects than JSON primitives.
+    """
+    if not _is_plain(model):
+        return None
+    return hashlib.sha1(json.dumps(model, sort_keys=True)).hexdigest()
+
+
+def view(path, stream=False, buffer_size=8192, cache_ttl=None, cache_key=None):
     """
     A view decorator that render a view by dict.
     :param path: path
+    :param stream: render and send the page chunk by chunk, the ctx is not
+                   available to the template while it is streamed
+    :param buffer_size: the characters of each chunk when streaming
+    :param cache_ttl: cache the rendered page for cache_ttl seconds, it is
+                      bypassed when the response sets cookies or session
+    :param cache_key: a function which makes the cache key of model, the
+                      hash of model by default, which only works for models of
+                      JSON primitives, other models are not cached
     :return:
     """
+    if stream and cache_ttl is not None:
+        raise ValueError('A streamed view cannot be cached.')
+
     def _decorator(func):
         @functools.wraps(func)
         def _wrapper(*args, **kw):
             r = func(*args, **kw)
             if isinstance(r, dict):
                 logging.info('Return Template')
-                return Template(path, **r)
+                t = Template(path, **r)
+                if stream:
+                    t.stream = True
+                    t.buffer_size = buffer_size
+                elif cache_ttl is not None:
+                    t.cache_ttl = cache_ttl
+                    t.cache_key = cache_key
+                return t
             raise ValueError('Expect return a dict when using @view() decorator.')
         return _wrapper
     return _decorator
@@ -564,23 +1287,82 @@ def _load_module(module_name):
     return getattr(m, import_module)
 
 
+def _call_in_context(context, fn, args):
+    """
+    call fn in a thread of the pool with the ctx of the calling greenlet.
+    The session store is flushed in the pool thread, since stores such as
+    SQLiteSessionStore keep the sessions loaded by a request per thread.
+    """
+    storage = ctx.__storage__
+    ident = ctx.__ident_func__()
+    storage[ident] = context
+    try:
+        return fn(*args)
+    finally:
+        try:
+            context.application.session_store.flush()
+        finally:
+            storage.pop(ident, None)
+
+
+_HTTP_METHODS = frozenset(['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS'])
+
+
 class Tindo(object):
-    def __init__(self, document_root, template_engine=None, debug=True, **kw):
+    def __init__(self, document_root, template_engine=None, debug=True, dispatch_cache_size=0,
+                 static_block_size=65536, static_max_age=None, static_cache_size=0,
+                 static_cache_check_interval=1.0, gzip=False, gzip_level=6, gzip_min_size=1024,
+                 gzip_cache_size=4194304, session_store=None, max_body_size=None, max_part_size=None,
+                 max_form_fields=None, spool_threshold=1048576, max_json_size=None, max_field_size=1048576,
+                 json_encoder=None,
+                 precompile_templates=None, template_cache_dir=None, view_cache_size=16777216,
+                 metrics=False, metrics_path='/metrics', **kw):
         self._running = False
+        self._threadpool = None
         self._document_root = document_root
         self._debug = debug
-
-        self._template_engine = Jinja2TemplateEngine(
-            os.path.join(self._document_root, 'templates')) if template_engine is None else None
-
-        self._get_dynamic = []
-        self._post_dynamic = []
-        self._get_dynamic.append(StaticFileRoute())
+        self._dispatch_cache = LRUCache(dispatch_cache_size) if dispatch_cache_size > 0 else None
+        self._gzip_level = gzip_level if gzip else None
+        self._gzip_min_size = gzip_min_size
+        self._session_store = MemorySessionStore() if session_store is None else session_store
+        self._request_options = dict(max_body_size=max_body_size, max_part_size=max_part_size,
+                                     max_form_fields=max_form_fields, spool_threshold=spool_threshold,
+                                     max_json_size=max_json_size, max_field_size=max_field_size)
+        self._json_encoder = _json_dumps if json_encoder is None else json_encoder
+
+        if template_engine is None:
+            if debug:
+                template_engine = Jinja2TemplateEngine(os.path.join(self._document_root, 'templates'))
+            else:
+                template_engine = Jinja2TemplateEngine(os.path.join(self._document_root, 'templates'),
+                                                       cache_size=-1, auto_reload=False,
+                                                       bytecode_cache_dir=template_cache_dir)
+        self._template_engine = template_engine
+        self._precompile_templates = (not debug) if precompile_templates is None else precompile_templates
+        self._view_cache = LRUCache(view_cache_size, sizeof=lambda item: len(item[1])) \
+            if view_cache_size > 0 else None
+
+        self._static_file_route = StaticFileRoute(static_block_size, static_max_age, static_cache_size,
+                                                  static_cache_check_interval,
+                                                  gzip_level=self._gzip_level, gzip_min_size=gzip_min_size,
+                                                  gzip_cache_size=gzip_cache_size)
+        self._exact_routes = {'GET': {}, 'POST': {}}
+        self._routers = {'GET': Router(), 'POST': Router()}
+
+        if metrics is True:
+            metrics = Metrics()
+        self._metrics = metrics or None
+        if self._metrics is not None and metrics_path is not None:
+            self.add_url(route(metrics_path)(self._metrics_page))
 
     def _check_not_running(self):
         if self._running:
             raise RuntimeError('Cannot modify the tindo when running')
 
+    @property
+    def session_store(self):
+        return self._session_store
+
     @property
     def template_engine(self):
         return self._template_engine
@@ -590,6 +1372,53 @@ class Tindo(object):
         self._check_not_running()
         self._template_engine = engine
 
+    @property
+    def dispatch_cache_info(self):
+        """
+        the hits, misses and size of the dispatch cache, None if disabled.
+        """
+        if self._dispatch_cache is None:
+            return None
+        return self._dispatch_cache.info
+
+    @property
+    def metrics(self):
+        """
+        the Metrics of requests, None if disabled.
+        """
+        return self._metrics
+
+    def metrics_text(self):
+        """
+        the metrics of requests, sessions and static file cache in the text
+        format of Prometheus.
+        """
+        gauges = [('tindo_sessions', 'gauge', 'The sessions kept by the session store.',
+                   len(self._session_store))]
+        info = self.static_cache_info
+        if info is not None:
+            gauges.append(('tindo_static_cache_hits_total', 'counter', 'The hits of the static file cache.',
+                           info.hits))
+            gauges.append(('tindo_static_cache_misses_total', 'counter', 'The misses of the static file cache.',
+                           info.misses))
+            lookups = info.hits + info.misses
+            gauges.append(('tindo_static_cache_hit_ratio', 'gauge', 'The hit ratio of the static file cache.',
+                           float(info.hits) / lookups if lookups else 0.0))
+        return self._metrics.render(gauges)
+
+    def _metrics_page(self):
+        ctx.response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        return self.metrics_text()
+
+    @property
+    def static_cache_info(self):
+        """
+        the hits, misses and size of the static file cache, None if disabled.
+        """
+        if self._static_file_route.cache is None:
+            return None
+        return self._static_file_route.cache.info
+
     def add_module(self, mod):
         self._check_not_running()
         m = mod if isinstance(mod, types.ModuleType) else _load_module(mod)
@@ -602,17 +1431,100 @@ class Tindo(object):
     def add_url(self, func):
         self._check_not_running()
         r = Route(func)
-        if 'GET' in r.methods:
-            self._get_dynamic.append(r)
-        if 'POST' in r.methods:
-            self._post_dynamic.append(r)
+        exact = _re_route.search(r.path) is None
+        for method in r.methods:
+            method = method.upper()
+            if method not in self._routers:
+                self._exact_routes[method] = {}
+                self._routers[method] = Router()
+            if exact:
+                self._exact_routes[method].setdefault(r.path, r)
+            else:
+                self._routers[method].add(r)
+        if self._dispatch_cache is not None:
+            self._dispatch_cache.clear()
         logging.info('Add route: %s' % str(r))
 
+    def precompile_templates(self):
+        """
+        compile all templates of the template engine.
+        :return: the number of compiled templates
+        """
+        count = self._template_engine.precompile()
+        logging.info('Precompile %d templates' % count)
+        return count
+
+    def _startup(self):
+        """
+        called once before serving the first request.
+        """
+        if self._precompile_templates:
+            self.precompile_templates()
+        self._running = True
+
     def run(self, port=9000, host='127.0.0.1'):
         from werkzeug.serving import run_simple
         logging.info('application (%s) will start at %s:%s' % (self._document_root, host, port))
+        if not self._running:
+            self._startup()
         run_simple(host, port, self)
 
+    def serve_gevent(self, port=9000, host='127.0.0.1', max_connections=1000, threadpool_size=10, **kw):
+        """
+        serve by the WSGI server of gevent, every connection is handled by a
+        greenlet, so a single process holds many idle or I/O-bound connections.
+        Call gevent.monkey.patch_all() before importing other modules, so that
+        sockets and threading.local used by handlers and session stores yield
+        to other greenlets. ctx becomes greenlet-local, and the functions of
+        route(blocking=True) are run in the thread pool of gevent's hub.
+        :param port: the port
+        :param host: the host
+        :param max_connections: the max number of connections served at the same time
+        :param threadpool_size: the max number of threads running blocking functions
+        :param kw: other keyword arguments of gevent.pywsgi.WSGIServer
+        """
+        from gevent import get_hub
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+        set_ident_func(ctx, greenlet_ident)
+        threadpool = get_hub().threadpool
+        threadpool.maxsize = threadpool_size
+        self._threadpool = threadpool
+        logging.info('application (%s) will start at %s:%s with gevent' % (self._document_root, host, port))
+        if not self._running:
+            self._startup()
+        WSGIServer((host, port), self, spawn=Pool(max_connections), **kw).serve_forever()
+
+    def serve(self, port=9000, host='127.0.0.1', workers=None, **kw):
+        """
+        serve by pre-forked worker processes for production. The templates
+        are precompiled before forking, so the workers share them. Sessions
+        of MemorySessionStore are not shared by workers, use SQLiteSessionStore
+        or SignedCookieSessionStore instead.
+        :param port: the port
+        :param host: the host
+        :param workers: the number of worker processes, defaults to the CPU count
+        :param kw: other keyword arguments of PreforkServer, such as max_requests,
+                   max_rss, keepalive_timeout and timeout
+        """
+        if not self._running:
+            self._startup()
+        PreforkServer(self, host, port, workers, **kw).serve_forever()
+
+    def serve_threaded(self, port=9000, host='127.0.0.1', threads=8, queue_size=64, **kw):
+        """
+        serve by a fixed pool of threads in one process, the connections beyond
+        the queue are answered by 503 at once.
+        :param port: the port
+        :param host: the host
+        :param threads: the number of threads
+        :param queue_size: the max number of connections waiting for a thread
+        :param kw: other keyword arguments of ThreadPoolServer
+        """
+        if not self._running:
+            self._startup()
+        ThreadPoolServer(self, host, port, threads, queue_size, **kw).serve_forever()
+
     def __call__(self, environ, start_response):
         """
         WSGI protocol, a callable instance
@@ -620,72 +1532,251 @@ class Tindo(object):
         :param start_response: wsgi start_response
         :return:
         """
-        return self._wsgi_app(environ, start_response, self._debug)
+        metrics = self._metrics
+        if metrics is None:
+            return self._wsgi_app(environ, start_response, self._debug)
+        method = environ.get('REQUEST_METHOD', 'GET')
+        timer = metrics.timer(method if method in _HTTP_METHODS else 'OTHER', start_response)
+        try:
+            body = self._wsgi_app(environ, timer.start_response, self._debug, timer)
+        except:
+            timer.finish()
+            raise
+        return timer.body(body, environ.get('wsgi.file_wrapper'))
 
-    def _dispatch_request(self):
+    def _dispatch_request(self, timer=None):
         """
         make response of route
+        :param timer: the timer of metrics
         :return:
         """
-        request_method = ctx.request.request_method
-        path_info = ctx.request.path_info
+        request = ctx.request
+        request_method = request.request_method
+        path_info = request.path_info
+        cache = self._dispatch_cache
+        if cache is None:
+            fn, args = self._match_route(request_method, path_info)
+        else:
+            key = (request_method, path_info)
+            r = cache.get(key)
+            if r is None:
+                r = self._match_route(request_method, path_info)
+                cache.set(key, r)
+            fn, args = r
+        if timer is not None:
+            timer.route = fn.path
+            timer.lap('dispatch')
+        if self._threadpool is not None and getattr(fn, 'blocking', False):
+            return self._threadpool.apply(_call_in_context, (ctx(), fn, args))
+        return fn(*args)
+
+    def _match_route(self, request_method, path_info):
+        """
+        find the route of request, the parameter-free paths are resolved by
+        one dict probe before walking the router.
+        A HEAD request without a HEAD route is served by the GET route.
+        :param request_method: the HTTP method
+        :param path_info: the url path
+        :return: a tuple of (Route, args)
+        """
+        if request_method == 'HEAD':
+            r = self._find_route('HEAD', path_info)
+            if r is not None:
+                return r
+            request_method = 'GET'
         if request_method == 'GET':
-            for fn in self._get_dynamic:
-                args = fn.match(path_info)
-                if args is not None:
-                    return fn(*args)
-            raise not_found()
-        if request_method == 'POST':
-            for fn in self._post_dynamic:
-                args = fn.match(path_info)
-                if args is not None:
-                    return fn(*args)
+            args = self._static_file_route.match(path_info)
+            if args is not None:
+                return self._static_file_route, args
+        elif request_method not in self._exact_routes and request_method not in _HTTP_METHODS:
+            bad_request()
+        r = self._find_route(request_method, path_info)
+        if r is None:
             raise not_found()
-        bad_request()
+        return r
 
-    def _wsgi_app(self, environ, start_response, debug=True):
-        self._running = True
-        _application = Dict(document_root=self._document_root)
+    def _find_route(self, request_method, path_info):
+        """
+        :return: a tuple of (Route, args), None if no route of request_method matches
+        """
+        routes = self._exact_routes.get(request_method)
+        if routes is None:
+            return None
+        fn = routes.get(path_info)
+        if fn is not None:
+            return fn, ()
+        return self._routers[request_method].match(path_info)
+
+    def _render_cached(self, template, response):
+        """
+        render template through the view cache, which is bypassed when the
+        response sets cookies or session.
+        """
+        if hasattr(response, '_cookies') or hasattr(response, '_session'):
+            return self._template_engine(template.template_name, template.model)
+        if template.cache_key is None:
+            model_hash = _model_hash(template.model)
+            if model_hash is None:
+                return self._template_engine(template.template_name, template.model)
+            key = (template.template_name, model_hash)
+        else:
+            key = (template.template_name, template.cache_key(template.model))
+        now = time.time()
+        item = self._view_cache.get(key)
+        if item is not None and item[0] > now:
+            return item[1]
+        body = self._template_engine(template.template_name, template.model)
+        if not hasattr(response, '_cookies') and not hasattr(response, '_session'):
+            self._view_cache.set(key, (now + template.cache_ttl, body))
+        return body
+
+    def invalidate_view(self, template_name=None, key=None):
+        """
+        drop the cached pages.
+        :param template_name: drop the pages of this template, all pages if None
+        :param key: drop the page of this cache key only
+        :return:
+        """
+        if self._view_cache is None:
+            return
+        if template_name is None:
+            self._view_cache.clear()
+        elif key is not None:
+            self._view_cache.pop((template_name, key))
+        else:
+            for k in self._view_cache.keys():
+                if k[0] == template_name:
+                    self._view_cache.pop(k)
+
+    @property
+    def view_cache_info(self):
+        """
+        the hits, misses and size of the view cache, None if disabled.
+        """
+        if self._view_cache is None:
+            return None
+        return self._view_cache.info
+
+    def _json_body(self, data, response):
+        body = to_str(self._json_encoder(data))
+        response.content_type = 'application/json; charset=utf-8'
+        response.content_length = len(body)
+        return body
 
-        ctx.application = _application
-        ctx.request = Request(environ)
-        response = ctx.response = Response()
+    def _save_session(self, response):
+        """
+        send the session cookie of a stateless store if the session was modified.
+        """
+        session = getattr(response, '_session', None)
+        if session is None:
+            session = getattr(ctx.request, '_session', None)
+        if session is not None and session.modified:
+            store = self._session_store
+            response.set_cookie(store.cookie_name, store.dumps(session), max_age=store.max_age,
+                                domain=store.domain, secure=store.secure)
+
+    def _compress(self, body, response):
+        """
+        gzip the body if it is large enough and the client accepts gzip.
+        """
+        if response.header('CONTENT-ENCODING') or not _is_compressible(response.header('CONTENT-TYPE')):
+            return body
+        _add_vary(response)
+        if len(body) < self._gzip_min_size or not _accepts_gzip():
+            return body
+        body = _gzip(body, self._gzip_level)
+        response.set_header('CONTENT-ENCODING', 'gzip')
+        response.content_length = len(body)
+        return body
+
+    def _wsgi_app(self, environ, start_response, debug=True, timer=None):
+        _application = Dict(document_root=self._document_root, session_store=self._session_store)
+
+        c = ctx()
+        c.application = _application
+        c.request = Request(environ, **self._request_options)
+        response = c.response = Response()
         try:
-            r = self._dispatch_request()
+            if not self._running:
+                self._startup()
+            r = self._dispatch_request(timer)
+            if timer is not None:
+                timer.lap('handler')
             if isinstance(r, Template):
-                r = self._template_engine(r.template_name, r.model)
+                if r.stream:
+                    r = self._template_engine.generate(r.template_name, r.model, r.buffer_size)
+                elif r.cache_ttl is not None and self._view_cache is not None:
+                    r = self._render_cached(r, response)
+                else:
+                    r = self._template_engine(r.template_name, r.model)
+            elif isinstance(r, dict):
+                r = self._json_body(r, response)
+            elif isinstance(r, JSONResponse):
+                if r.status is not None:
+                    response.status = r.status
+                r = self._json_body(r.data, response)
             if isinstance(r, unicode):
                 r = r.encode('utf-8')
             if r is None:
                 r = []
+            if self._gzip_level is not None and isinstance(r, str):
+                r = self._compress(r, response)
+            if self._session_store.stateless:
+                self._save_session(response)
+            else:
+                self._session_store.flush()
+            r = _normalize_body(r, response)
+            if timer is not None:
+                timer.lap('render')
             start_response(response.status, response.headers)
             return r
         except RedirectError, e:
+            if self._session_store.stateless:
+                self._save_session(response)
+            else:
+                try:
+                    self._session_store.flush()
+                except Exception, error:
+                    logging.exception(error)
+                    return self._internal_error(start_response, debug)
             response.set_header('location', e.location)
+            response.content_length = 0
             start_response(e.status, response.headers)
             return []
         except HttpError, e:
+            body = _error_page(e.status)
+            response.content_length = len(body)
             start_response(e.status, response.headers)
-            return ['<html><body><h1>', e.status, '</h1></body></html>']
+            return [body]
         except Exception, e:
             logging.exception(e)
-            if not debug:
-                start_response('500 Internal Server Error', [])
-                return ['<html><body><h1>500 Internal Server Error</h1></body></html>']
+            return self._internal_error(start_response, debug)
+        finally:
+            try:
+                self._session_store.flush()
+            except Exception, e:
+                logging.exception(e)
+            finally:
+                release_local(ctx)
+
+    def _internal_error(self, start_response, debug):
+        """
+        respond 500 for the exception being handled, with its traceback in debug mode.
+        """
+        if not debug:
+            body = _error_page('500 Internal Server Error')
+        else:
             exc_type, exc_value, exc_traceback = sys.exc_info()
-            fp = StringIO()
+            fp = StringIO.StringIO()
             traceback.print_exception(exc_type, exc_value, exc_traceback, file=fp)
             stacks = fp.getvalue()
             fp.close()
-            start_response('500 Internal Server Error', [])
-            return [
+            body = ''.join([
                 r'''<html><body><h1>
                 500 Internal Server Error</h1>
                 <div style="font-family:Monaco, Menlo, Consolas, 'Courier New', monospace;">
                 <pre>''',
                 stacks.replace('<', '&lt;').replace('>', '&gt;'),
-                '</pre></div></body></html>']
-        finally:
-            del ctx.application
-            del ctx.request
-            del ctx.response
+                '</pre></div></body></html>'])
+        start_response('500 Internal Server Error', [_DEFAULT_CONTENT_TYPE, ('Content-Length', str(len(body)))])
+        return [body]
@@ -4,6 +4,8 @@
 """
 import datetime
 import re
+from collections import OrderedDict
+from threading import Lock
 
 
 class Dict(dict):
@@ -61,3 +63,77 @@ class UTC(datetime.tzinfo):
         return 'UTC tzinfo object (%s)' % self._tzname
 
     __repr__ = __str__
+
+
+class LRUCache(object):
+    """A thread-safe least-recently-used cache which counts hits and misses.
+    By default maxsize is the number of entries, if sizeof is given it is
+    the budget of sizeof(value) summed over all entries, such as bytes.
+    """
+    def __init__(self, maxsize=128, sizeof=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.currsize = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                item = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = item
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        size = 1 if self.sizeof is None else self.sizeof(value)
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self.currsize -= item[1]
+            if size > self.maxsize:
+                return
+            self._data[key] = (value, size)
+            self.currsize += size
+            while self.currsize > self.maxsize:
+                _, item = self._data.popitem(last=False)
+                self.currsize -= item[1]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return default
+            self.currsize -= item[1]
+            return item[0]
+
+    def keys(self):
+        with self._lock:
+            return self._data.keys()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.currsize = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def info(self):
+        return Dict(hits=self.hits, misses=self.misses, size=len(self._data),
+                    currsize=self.currsize, maxsize=self.maxsize)
+
+    def __str__(self):
+        return 'LRUCache (hits=%d, misses=%d, size=%d, currsize=%d, maxsize=%d)' % (
+            self.hits, self.misses, len(self._data), self.currsize, self.maxsize)
+
+    __repr__ = __str__